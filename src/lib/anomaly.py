@@ -13,10 +13,23 @@
 # limitations under the License.
 
 import warnings
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+import numpy
 from pandas import DataFrame
 from pandas.api.types import is_numeric_dtype
-from .cast import safe_float_cast
+from .cast import safe_float_cast_series
+
+# Columns of the anomaly reports, each row of a report is a single anomaly; the key is only set for
+# anomalies detected within the records of a single key
+REPORT_COLUMNS = ["tags", "key", "anomaly", "column", "message"]
+
+# Message used for each type of anomaly, formatted with the name of the offending column
+ANOMALY_MESSAGES = {
+    "missing_column": "Missing column from schema: {}",
+    "null_column": "Null column detected: {}",
+    "stale_column": "Stale column detected: {}",
+    "zero_column": "All-zeroes column detected: {}",
+}
 
 
 def _detect_perform_action(msg: str, tags: List[str], action: str):
@@ -25,65 +38,180 @@ def _detect_perform_action(msg: str, tags: List[str], action: str):
         warnings.warn(msg)
     elif action == "raise":
         raise ValueError(msg)
-    else:
+    elif action != "ignore":
         raise TypeError("Unknown action {}".format(action))
 
 
+def _build_report(
+    anomalies: List[Tuple[List[str], Optional[str], str, str]], action: str
+) -> DataFrame:
+    """ Performs the action for each <tags, key, anomaly, column> and returns them as a report """
+    records = []
+    for tags, key, anomaly, column in anomalies:
+        message = ANOMALY_MESSAGES[anomaly].format(column)
+        _detect_perform_action(message, tags if key is None else [*tags, key], action)
+        records.append(("".join([f"[{tag}]" for tag in tags]), key, anomaly, column, message))
+    return DataFrame.from_records(records, columns=REPORT_COLUMNS)
+
+
+def profile_columns(schema: Dict[str, type], data: DataFrame) -> DataFrame:
+    """
+    Computes the statistics used to detect anomalies for all columns of a table at once.
+
+    Arguments:
+        schema: Dictionary of <column, type> of the table.
+        data: Table to profile.
+    Returns:
+        DataFrame: Table indexed by column name, with the number of non-null values in
+            `valid_count`, the sum of absolute values of numeric columns in `absolute_sum` and the
+            last date with a non-null value in `last_valid_date`, if the schema has a date column.
+    """
+    not_null = data.notna()
+    profile = DataFrame(index=data.columns)
+    profile["valid_count"] = not_null.sum().values
+
+    # The sum of absolute values is only computed for numeric columns, it's null for the rest
+    numeric_columns = [col for col in data.columns if is_numeric_dtype(data[col])]
+    absolute_values = DataFrame(
+        {col: safe_float_cast_series(data[col]).abs() for col in numeric_columns},
+        index=data.index,
+    )
+    profile["absolute_sum"] = absolute_values.sum().reindex(profile.index)
+
+    # Compare dates by their rank, so the last valid date is the maximum rank of valid values;
+    # records without a date have a rank of -1 so they never count as the last valid date
+    if "date" in schema and "date" in data.columns:
+        dates = data.date.values
+        ranked_dates = numpy.sort(data.date.dropna().unique())
+        ranks = numpy.full(len(data), -1)
+        dated = not_null["date"].values
+        ranks[dated] = numpy.searchsorted(ranked_dates, dates[dated])
+        last_ranks = [ranks[not_null[col].values].max(initial=-1) for col in data.columns]
+        profile["last_valid_date"] = [
+            ranked_dates[rank] if rank >= 0 else None for rank in last_ranks
+        ]
+
+    return profile
+
+
+def _missing_columns(schema: Dict[str, type], data: DataFrame) -> List[str]:
+    return [column for column in schema.keys() if column not in data.columns]
+
+
+def _null_columns(profile: DataFrame) -> List[str]:
+    return profile.index[profile.valid_count == 0].tolist()
+
+
+def _zero_columns(profile: DataFrame, row_count: int) -> List[str]:
+    if row_count == 0:
+        return []
+    mask = (profile.valid_count > 0) & (profile.absolute_sum.fillna(numpy.inf) < 1)
+    return profile.index[mask].tolist()
+
+
+def _stale_columns(profile: DataFrame, data: DataFrame) -> List[str]:
+    if "last_valid_date" not in profile.columns:
+        return []
+
+    # A column is stale if none of its values are in the last 3 dates of the table
+    last_dates = numpy.sort(data.date.dropna().unique())[-3:]
+    dates = profile.last_valid_date.dropna()
+    return dates.index[dates < last_dates[0]].tolist() if len(last_dates) > 0 else []
+
+
 def detect_correct_schema(
     schema: Dict[str, type], data: DataFrame, tags: List[str], action: str = "warn"
-) -> None:
-    missing_columns = set(schema.keys()).difference(data.columns)
-    if len(missing_columns) > 0:
-        _detect_perform_action(
-            "Missing columns from schema: {}".format(missing_columns), tags, action
-        )
+) -> DataFrame:
+    anomalies = [(tags, None, "missing_column", col) for col in _missing_columns(schema, data)]
+    return _build_report(anomalies, action)
 
 
 def detect_null_columns(
     schema: Dict[str, type], data: DataFrame, tags: List[str], action: str = "warn"
-) -> None:
-    for column in data.columns:
-        if sum(~data[column].isnull()) == 0:
-            _detect_perform_action("Null column detected: " + column, tags, action)
+) -> DataFrame:
+    profile = profile_columns(schema, data)
+    anomalies = [(tags, None, "null_column", col) for col in _null_columns(profile)]
+    return _build_report(anomalies, action)
 
 
 def detect_zero_columns(
     schema: Dict[str, type], data: DataFrame, tags: List[str], action: str = "warn"
-) -> None:
-    for column in data.columns:
-        if len(data[column]) == 0:
-            continue
-        if not is_numeric_dtype(data[column]):
-            continue
-        if sum(~data[column].isnull()) == 0:
-            # Already flagged by detect_null_columns
-            continue
-        if sum(data[column].apply(safe_float_cast).fillna(0).apply(abs)) < 1:
-            _detect_perform_action("All-zeroes column detected: " + column, tags, action)
+) -> DataFrame:
+    profile = profile_columns(schema, data)
+    anomalies = [(tags, None, "zero_column", col) for col in _zero_columns(profile, len(data))]
+    return _build_report(anomalies, action)
 
 
 def detect_stale_columns(
     schema: Dict[str, type], data: DataFrame, tags: List[str], action: str = "warn"
-) -> None:
+) -> DataFrame:
     if "date" not in schema:
-        return
-    last_dates = list(sorted(data.date.unique()))[-3:]
-    for column in data.columns:
-        subset = data[["date", column]].dropna()
-        if len(subset) == 0:
-            # Already flagged by detect_null_columns
-            continue
-        if len(subset[subset.date.isin(last_dates)]) == 0:
-            _detect_perform_action("Stale column detected: " + column, tags, action)
+        return _build_report([], action)
+    profile = profile_columns(schema, data)
+    anomalies = [(tags, None, "stale_column", col) for col in _stale_columns(profile, data)]
+    return _build_report(anomalies, action)
+
+
+def detect_stale_columns_by_key(
+    schema: Dict[str, type],
+    data: DataFrame,
+    tags: List[str],
+    action: str = "warn",
+    key_column: str = "key",
+) -> DataFrame:
+    """
+    Equivalent to calling `detect_stale_columns` with the records of each key separately, but
+    computed for all keys at once using a single grouping operation. The key of each anomaly is
+    reported in the `key` column and also added to the tags of its message.
+    """
+    if "date" not in schema or len(data) == 0:
+        return _build_report([], action)
+    keys = data[key_column]
+    dated = data.date.notna().values & keys.notna().values
+
+    # A record is recent if its date is one of the last 3 distinct dates of its key
+    key_dates = data.loc[dated, [key_column, "date"]].drop_duplicates()
+    key_dates = key_dates.sort_values("date", ascending=False, kind="mergesort")
+    key_dates = key_dates[key_dates.groupby(key_column, sort=False).cumcount() < 3]
+    thresholds = key_dates.groupby(key_column, sort=False).date.min()
+    recent = numpy.zeros(len(data), dtype=bool)
+    recent[dated] = data.date.values[dated] >= keys[dated].map(thresholds).values
+
+    # A column is stale for a key if it has values, but none of them are recent
+    not_null = data.notna().values & dated[:, numpy.newaxis]
+    has_values = DataFrame(not_null, columns=data.columns).groupby(keys.values, sort=False).any()
+    has_recent = (
+        DataFrame(not_null & recent[:, numpy.newaxis], columns=data.columns)
+        .groupby(keys.values, sort=False)
+        .any()
+    )
+    stale = has_values & ~has_recent
+    anomalies = [
+        (tags, key, "stale_column", column)
+        for key, row in stale[stale.any(axis=1)].iterrows()
+        for column in row.index[row.values]
+    ]
+    return _build_report(anomalies, action)
 
 
 def detect_anomaly_all(
     schema: Dict[str, type], data: DataFrame, tags: List[str], action: str = "warn"
-) -> None:
-    for detector in (
-        detect_correct_schema,
-        detect_null_columns,
-        detect_stale_columns,
-        detect_zero_columns,
-    ):
-        detector(schema, data, tags, action)
+) -> DataFrame:
+    """
+    Runs all the anomaly detectors on the given table, profiling all of its columns only once.
+
+    Arguments:
+        schema: Dictionary of <column, type> of the table.
+        data: Table to verify.
+        tags: Tags added to the anomaly messages, typically the name of the pipeline.
+        action: What to do for each anomaly found, either "warn", "raise" or "ignore".
+    Returns:
+        DataFrame: Report with one row for each anomaly found, see `REPORT_COLUMNS`.
+    """
+    profile = profile_columns(schema, data)
+    anomalies = [(tags, None, "missing_column", col) for col in _missing_columns(schema, data)]
+    anomalies += [(tags, None, "null_column", col) for col in _null_columns(profile)]
+    if "date" in schema:
+        anomalies += [(tags, None, "stale_column", col) for col in _stale_columns(profile, data)]
+    anomalies += [(tags, None, "zero_column", col) for col in _zero_columns(profile, len(data))]
+    return _build_report(anomalies, action)
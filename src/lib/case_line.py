@@ -13,8 +13,9 @@
 # limitations under the License.
 
 import re
-from typing import Any, Callable, Dict, List
-from pandas import DataFrame, isna
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import numpy
+from pandas import DataFrame, Series, concat, factorize, isna
 from unidecode import unidecode
 from lib.cast import age_group, safe_int_cast
 from lib.constants import SRC
@@ -57,6 +58,9 @@ def _default_age_adapter(value: Any) -> str:
     return "age_unknown"
 
 
+# Number of partial counts kept in memory by `CaseLineAggregator` before they are combined
+CASE_LINE_MAX_PARTIAL_COUNTS = 16
+
 DEFAULT_BIN_ADAPTERS = {
     "age": _default_age_adapter,
     "sex": _default_adapter_factory("sex"),
@@ -64,6 +68,118 @@ DEFAULT_BIN_ADAPTERS = {
 }
 
 
+def _map_unique(values: Series, adapter: Callable[[Any], str], cache: Dict[Any, str]) -> Series:
+    """ Applies the adapter only once per unique value, using `cache` to remember past results """
+    codes, uniques = factorize(values)
+    mapped = []
+    for value in uniques:
+        if value not in cache:
+            cache[value] = adapter(value)
+        mapped.append(cache[value])
+
+    # Null values are assigned the code -1, which takes the last item of the mapped values
+    mapped.append(adapter(numpy.nan) if (codes == -1).any() else None)
+    return Series(numpy.array(mapped, dtype=object)[codes], index=values.index, name=values.name)
+
+
+class CaseLineAggregator:
+    """
+    Aggregates line (individual case) data into time-series data, see
+    `convert_cases_to_time_series` for details about the input and output formats. Cases can be
+    added in chunks, which are reduced to counts as soon as they are added, so line lists which do
+    not fit in memory can be aggregated incrementally.
+    """
+
+    def __init__(
+        self, index_columns: List = None, bin_adapters: Dict[str, Callable[[Any], str]] = None
+    ):
+        self.index_columns = ["key"] if index_columns is None else index_columns
+
+        # Fill in the bin adapters with default implementations
+        self.bin_adapters = {**(bin_adapters or {}), **DEFAULT_BIN_ADAPTERS}
+
+        # Columns are determined from the first chunk of cases
+        self._group_columns: Optional[List[str]] = None
+        self._date_columns: List[str] = []
+        self._adapter_cache: Dict[str, Dict[Any, str]] = {}
+        self._partial_counts: List[Series] = []
+
+    def _init_columns(self, cases: DataFrame) -> None:
+        assert all(
+            col in cases.columns for col in self.index_columns
+        ), f"Expected all columns {self.index_columns} to be in {cases.columns}"
+
+        string_columns = cases.select_dtypes(include="object")
+        assert all(
+            col in string_columns for col in self.index_columns
+        ), f"Expected for all {self.index_columns} to be of type string"
+
+        self.bin_adapters = {
+            col: adapter for col, adapter in self.bin_adapters.items() if col in cases.columns
+        }
+        self._adapter_cache = {col: {} for col in self.bin_adapters}
+        self._group_columns = ["date"] + self.index_columns + list(self.bin_adapters.keys())
+        self._date_columns = [col for col in cases.columns if col.startswith("date_")]
+
+    def _combine_counts(self) -> Optional[Series]:
+        if not self._partial_counts:
+            return None
+        counts = concat(self._partial_counts)
+        counts = counts.groupby(level=list(range(counts.index.nlevels))).sum()
+        self._partial_counts = [counts]
+        return counts
+
+    def add(self, cases: DataFrame) -> None:
+        """
+        Adds a chunk of cases to the aggregated counts.
+
+        Arguments:
+            cases: DataFrame in the case-line format, with the same columns for all chunks.
+        """
+        if self._group_columns is None:
+            self._init_columns(cases)
+
+        # Apply the bin adapters to the unique values of all the known, allowed bucket types
+        id_columns = self._group_columns[1:]
+        data = {col: cases[col] for col in self.index_columns}
+        for col, adapter in self.bin_adapters.items():
+            data[col] = _map_unique(cases[col], adapter, self._adapter_cache[col])
+        data.update({col: cases[col] for col in self._date_columns})
+
+        # Go from individual case records to a long table with one record per <case, statistic>
+        data = DataFrame(data, index=cases.index).melt(
+            id_vars=id_columns,
+            value_vars=self._date_columns,
+            var_name="statistic",
+            value_name="date",
+        )
+
+        # Index columns are all expected to be of str type so we replace NaN with empty string
+        # Replacement necessary to work around https://github.com/pandas-dev/pandas/issues/3729
+        data = data.dropna(subset=["date"]).fillna("")
+        if len(data) > 0:
+            self._partial_counts.append(data.groupby(self._group_columns + ["statistic"]).size())
+        if len(self._partial_counts) >= CASE_LINE_MAX_PARTIAL_COUNTS:
+            self._combine_counts()
+
+    def result(self) -> DataFrame:
+        """
+        Returns:
+            DataFrame: time-series formatted data table with the counts of all the cases added
+        """
+        group_columns = self._group_columns or ["date"] + self.index_columns
+        value_columns = [col.split("date_")[-1] for col in self._date_columns]
+        counts = self._combine_counts()
+        if counts is None:
+            return DataFrame(columns=group_columns + value_columns)
+
+        # We can fill all missing records as zero since we know we have "perfect" information
+        data = counts.unstack("statistic", fill_value=0)
+        data = data.reindex(columns=self._date_columns, fill_value=0)
+        data.columns = value_columns
+        return data.reset_index()
+
+
 def convert_cases_to_time_series(
     cases: DataFrame,
     index_columns: List = None,
@@ -94,43 +210,30 @@ def convert_cases_to_time_series(
     Returns:
         DataFrame: time-series formatted data table
     """
-    index_columns = ["key"] if index_columns is None else index_columns
-
-    assert all(
-        col in cases.columns for col in index_columns
-    ), f"Expected all columns {index_columns} to be in {cases.columns}"
-
-    string_columns = cases.select_dtypes(include="object")
-    assert all(
-        col in string_columns for col in index_columns
-    ), f"Expected for all {index_columns} to be of type string"
-
-    # Fill in the bin adapters with default implementations
-    bin_adapters = {**(bin_adapters or {}), **DEFAULT_BIN_ADAPTERS}
-    bin_adapters = {col: adapter for col, adapter in bin_adapters.items() if col in cases.columns}
-
-    # Remove all columns which are not indexable
-    index_columns = ["date"] + index_columns + list(bin_adapters.keys())
-    cases = cases[[col for col in cases.columns if col in index_columns or col.startswith("date_")]]
-    cases = cases.copy()
-
-    # Apply the bin adapters to all of the known, allowed bucket types
-    for col, adapter in bin_adapters.items():
-        cases[col] = cases[col].apply(adapter)
-
-    # Go from individual case records to key-grouped records in a flat table
-    merged: DataFrame = None
-    for value_column in [col.split("date_")[-1] for col in cases.columns if "date_" in col]:
-        subset = cases.rename(columns={"date_{}".format(value_column): "date"})[index_columns]
-        # Index columns are all expected to be of str type so we replace NaN with empty string
-        # Replacement necessary to work around https://github.com/pandas-dev/pandas/issues/3729
-        subset = subset.dropna(subset=["date"]).fillna("")
-        subset[value_column] = 1
-        subset = subset.groupby(index_columns).sum().reset_index()
-        if merged is None:
-            merged = subset
-        else:
-            merged = merged.merge(subset, how="outer")
-
-    # We can fill all missing records as zero since we know we have "perfect" information
-    return merged.fillna(0)
+    return convert_case_chunks_to_time_series(
+        [cases], index_columns=index_columns, bin_adapters=bin_adapters
+    )
+
+
+def convert_case_chunks_to_time_series(
+    chunks: Iterable[DataFrame],
+    index_columns: List = None,
+    bin_adapters: Dict[str, Callable[[Any], str]] = None,
+) -> DataFrame:
+    """
+    Same as `convert_cases_to_time_series`, but the cases are read from an iterable of chunks so
+    line lists larger than the available memory can be aggregated, for example using the output
+    of `pandas.read_csv(..., chunksize=N)`.
+
+    Arguments:
+        chunks: DataFrames in the case-line format, all of them with the same columns
+        index_columns: Columns which will be used for grouping regardless of buckets
+        bin_adapters: Map of <column name, adapter> where the adapter takes a case value as input
+            outputs a bucket value, for example age adapter `(3) -> "0-9"`
+    Returns:
+        DataFrame: time-series formatted data table
+    """
+    aggregator = CaseLineAggregator(index_columns=index_columns, bin_adapters=bin_adapters)
+    for chunk in chunks:
+        aggregator.add(chunk)
+    return aggregator.result()
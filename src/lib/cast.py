@@ -15,8 +15,12 @@
 import re
 import datetime
 import warnings
+import numpy
 import pandas
 from typing import Any, Dict, Callable, Optional
+from pandas import Series
+from pandas.api.types import is_numeric_dtype
+from pandas.arrays import IntegerArray
 
 
 def safe_float_cast(value: Any) -> Optional[float]:
@@ -89,6 +93,83 @@ def column_converters(schema: Dict[str, Any]) -> Dict[str, Callable]:
     return converters
 
 
+def safe_float_cast_series(values: Series) -> Series:
+    """
+    Vectorized version of `safe_float_cast` which produces the same results as applying it to
+    every value of the series, but only falls back to parsing values one by one for those which
+    cannot be parsed in bulk.
+    """
+    if is_numeric_dtype(values):
+        return values.astype(float)
+
+    result = numpy.full(len(values), numpy.nan)
+    valid_mask = (values.notna() & (values != "")).values
+    if not valid_mask.any():
+        return Series(result, index=values.index, name=values.name)
+
+    valid_values = values[valid_mask]
+    strings = valid_values.astype(str)
+    strings = strings.str.replace(",", "", regex=False).str.replace("−", "-", regex=False)
+    try:
+        result[valid_mask] = strings.astype(float).values
+    except (TypeError, ValueError):
+        # Use the lenient parser to find which values cannot be parsed, but parse the rest using
+        # Python's float to make sure the results are identical to `safe_float_cast`. The values
+        # which cannot be parsed are passed to it as they were, since booleans are numbers there
+        parsed = numpy.array(pandas.to_numeric(strings, errors="coerce"), dtype=float)
+        invalid_mask = numpy.isnan(parsed)
+        try:
+            parsed[~invalid_mask] = strings[~invalid_mask].astype(float).values
+        except (TypeError, ValueError):
+            invalid_mask[:] = True
+        parsed[invalid_mask] = numpy.array(
+            [safe_float_cast(value) for value in valid_values[invalid_mask]], dtype=float
+        )
+        result[valid_mask] = parsed
+
+    return Series(result, index=values.index, name=values.name)
+
+
+def safe_int_cast_series(values: Series) -> Series:
+    """
+    Vectorized version of `safe_int_cast` using the default (half to even) rounding function.
+    Values which cannot be represented as a 64-bit integer are considered null.
+    """
+    floats = safe_float_cast_series(values).values
+    with numpy.errstate(invalid="ignore"):
+        mask = ~numpy.isfinite(floats) | (numpy.abs(floats) >= 2 ** 63)
+    ints = numpy.where(mask, 0, numpy.rint(floats)).astype("int64")
+    return Series(IntegerArray(ints, mask), index=values.index, name=values.name)
+
+
+def safe_str_cast_series(values: Series) -> Series:
+    """ Vectorized version of `safe_str_cast` """
+    # Dates are formatted differently in bulk, so convert them to objects to use `str` instead
+    if values.dtype.kind in ("m", "M"):
+        values = values.astype(object)
+    result = values.astype(str).astype(object)
+    result[values.isna()] = None
+    return result
+
+
+def column_casters(schema: Dict[str, Any]) -> Dict[str, Callable[[Series], Series]]:
+    """
+    Vectorized version of `column_converters`, which returns functions that take an entire column
+    as input instead of a single value.
+    """
+    casters: Dict[str, Callable[[Series], Series]] = {}
+    for column, dtype in schema.items():
+        if dtype == "int" or dtype == pandas.Int64Dtype():
+            casters[column] = safe_int_cast_series
+        elif dtype == "float":
+            casters[column] = safe_float_cast_series
+        elif dtype == "str":
+            casters[column] = safe_str_cast_series
+        else:
+            raise ValueError(f"Unsupported dtype {dtype} for column {column}")
+    return casters
+
+
 def age_group(age: int, bin_count: int = 10, age_cutoff: int = 90) -> str:
     """
     Categorical age group given a specific age, codified into a function to enforce consistency.
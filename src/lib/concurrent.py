@@ -12,12 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+import multiprocessing
 from os import getenv
-from typing import Any, Callable, Iterable
+from functools import partial
+from typing import Any, Callable, Dict, Iterable
 from tqdm.contrib import concurrent
 from multiprocessing.pool import Pool, ThreadPool
 from .io import GLOBAL_DISABLE_PROGRESS
 
+# Registry of objects shared with worker processes, which inherit it when they are forked
+_SHARED_OBJECTS: Dict[int, Any] = {}
+_SHARED_OBJECTS_COUNTER = itertools.count()
+
 
 class _ProcessExecutor(Pool):
     def __init__(self, max_workers: int = None, **kwargs):
@@ -35,10 +42,49 @@ class _ThreadExecutor(ThreadPool):
         return self.imap(func, iterable)
 
 
-def process_map(map_func: Callable, map_iter: Iterable[Any], **tqdm_kwargs):
+class SharedObject:
+    """
+    Handle to an object shared with the worker processes created by `process_map`. When worker
+    processes are forked, they inherit the memory of the parent process so only an identifier is
+    serialized and the object's memory is shared (copy-on-write) across all workers. Otherwise,
+    the object is serialized along with the handle like any other argument.
+
+    The handle must be created before the worker processes, and it can be used as a context
+    manager to release the object from the registry once it is no longer needed.
+    """
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+        self.key = next(_SHARED_OBJECTS_COUNTER)
+        _SHARED_OBJECTS[self.key] = obj
+
+    def __getstate__(self):
+        if multiprocessing.get_start_method() == "fork":
+            return {"key": self.key}
+        return {"key": self.key, "obj": self.obj}
+
+    def __setstate__(self, state):
+        self.key = state["key"]
+        self.obj = state["obj"] if "obj" in state else _SHARED_OBJECTS[self.key]
+
+    def __enter__(self) -> "SharedObject":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+    def release(self) -> None:
+        """ Removes the object from the registry, so it is no longer held by this handle """
+        _SHARED_OBJECTS.pop(self.key, None)
+
+
+def process_map(
+    map_func: Callable, map_iter: Iterable[Any], max_tasks_per_child: int = None, **tqdm_kwargs
+):
     tqdm_kwargs = {**{"disable": getenv(GLOBAL_DISABLE_PROGRESS)}, **tqdm_kwargs}
+    executor = partial(_ProcessExecutor, maxtasksperchild=max_tasks_per_child)
     # pylint: disable=protected-access
-    return concurrent._executor_map(_ProcessExecutor, map_func, map_iter, **tqdm_kwargs)
+    return concurrent._executor_map(executor, map_func, map_iter, **tqdm_kwargs)
 
 
 def thread_map(map_func: Callable, map_iter: Iterable[Any], **tqdm_kwargs):
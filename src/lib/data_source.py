@@ -12,17 +12,67 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import re
+import threading
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from contextlib import nullcontext
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Optional
 
 import numpy
-from pandas import DataFrame, isna
+from pandas import DataFrame, concat, isna
+from pandas.api.types import is_numeric_dtype
 
+from .concurrent import thread_map
 from .error_logger import ErrorLogger
-from .io import read_file, fuzzy_text
+from .io import read_file
+from .metadata import KeyResolver
 from .net import download_snapshot
-from .utils import infer_new_and_total, stratify_age_sex_ethnicity
+from .utils import infer_new_and_total, rename_age_buckets, stack_age_sex_ethnicity
+
+# Maximum number of resources which are downloaded concurrently, unless a lower limit is set in
+# the config of the pipeline or the data source
+DEFAULT_FETCH_CONCURRENCY = 8
+
+# Parse options which are passed along to `read_file` when reading the fetched resources
+READ_OPTS = ("sep", "encoding", "low_memory", "sheet_name", "usecols", "error_bad_lines")
+
+
+class _CopyOnAccessTables(MutableMapping):
+    """
+    Dictionary-like view of the auxiliary tables which only makes a copy of a table the first time
+    that it is accessed, so data sources which do not use a table never duplicate it in memory.
+    """
+
+    def __init__(self, tables: Dict[str, DataFrame]):
+        self._tables = tables
+        self._copies: Dict[str, DataFrame] = {}
+
+    def __getitem__(self, name: str) -> DataFrame:
+        if name not in self._copies:
+            self._copies[name] = self._tables[name].copy()
+        return self._copies[name]
+
+    def __setitem__(self, name: str, table: DataFrame) -> None:
+        self._copies[name] = table
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self._copies and name not in self._tables:
+            raise KeyError(name)
+        self._copies.pop(name, None)
+        self._tables = {key: value for key, value in self._tables.items() if key != name}
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._tables.keys()
+        yield from (name for name in self._copies.keys() if name not in self._tables)
+
+    def __len__(self) -> int:
+        return len(set(self._tables.keys()) | set(self._copies.keys()))
+
+    def copy(self) -> "_CopyOnAccessTables":
+        """ Shallow copy like `dict.copy`, tables not accessed yet are still copied on access """
+        tables = _CopyOnAccessTables(self._tables)
+        tables._copies = dict(self._copies)
+        return tables
 
 
 class DataSource(ErrorLogger):
@@ -44,6 +94,10 @@ class DataSource(ErrorLogger):
 
     config: Dict[str, Any]
 
+    _key_resolver: Optional[KeyResolver] = None
+
+    _fetch_semaphore: Optional[threading.Semaphore] = None
+
     def __init__(self, config: Dict[str, Any] = None):
         super().__init__()
         self.config = config or {}
@@ -64,27 +118,79 @@ class DataSource(ErrorLogger):
                 the "name" as the key if it is defined in `config`, otherwise the keys are ordinal
                 numbers based on the order of the URLs.
         """
-        return {
-            source_config.get("name", idx): download_snapshot(
-                source_config["url"], output_folder, **source_config.get("opts", {})
+
+        def download_func(source_config: Dict[str, Any]) -> str:
+            # Hold one of the download slots shared with the other data sources, if any
+            with self._fetch_semaphore or nullcontext():
+                return download_snapshot(
+                    source_config["url"], output_folder, **source_config.get("opts", {})
+                )
+
+        # Resources are independent from each other, so they can be downloaded concurrently
+        concurrency = self.config.get("fetch_concurrency", DEFAULT_FETCH_CONCURRENCY)
+        if concurrency <= 1 or len(fetch_opts) <= 1:
+            file_paths = list(map(download_func, fetch_opts))
+        else:
+            max_workers = min(concurrency, len(fetch_opts))
+            file_paths = thread_map(
+                download_func, fetch_opts, max_workers=max_workers, disable=True
             )
-            for idx, source_config in enumerate(fetch_opts)
+
+        # Results preserve the order of the inputs, so they can be matched with their names
+        return {
+            source_config.get("name", idx): file_path
+            for idx, (source_config, file_path) in enumerate(zip(fetch_opts, file_paths))
         }
 
     def _read(self, file_paths: Dict[str, str], **read_opts) -> List[DataFrame]:
         """ Reads a raw file input path into a DataFrame """
         return {name: read_file(file_path, **read_opts) for name, file_path in file_paths.items()}
 
+    def _read_chunks(
+        self, file_paths: Dict[str, str], chunksize: int, **read_opts
+    ) -> Iterator[Dict[str, DataFrame]]:
+        """
+        Reads the raw file input paths in chunks of at most `chunksize` records.
+
+        Only the first resource is read in chunks, and only if it is a CSV file or an archive
+        containing one. The rest of the resources are read completely into memory once and passed
+        along with every chunk, so the largest resource must be listed first in the `fetch` config
+        and memory usage is still bounded by the size of the other resources.
+        """
+        names = list(file_paths.keys())
+        if not names:
+            return
+        others = {name: read_file(file_paths[name], **read_opts) for name in names[1:]}
+        for chunk in read_file(file_paths[names[0]], chunksize=chunksize, **read_opts):
+            yield {names[0]: chunk, **others}
+
     def parse(self, sources: Dict[str, str], aux: Dict[str, DataFrame], **parse_opts) -> DataFrame:
         """ Parses a list of raw data records into a DataFrame. """
         # Some read options are passed as parse_opts
-        read_opts = {
-            k: v
-            for k, v in parse_opts.items()
-            if k in ("sep", "encoding", "low_memory", "sheet_name", "usecols", "error_bad_lines")
-        }
+        read_opts = {k: v for k, v in parse_opts.items() if k in READ_OPTS}
         return self.parse_dataframes(self._read(sources, **read_opts), aux, **parse_opts)
 
+    def parse_chunks(
+        self, sources: Dict[str, str], aux: Dict[str, DataFrame], **parse_opts
+    ) -> Iterator[DataFrame]:
+        """
+        Parses the raw data records in chunks if the `chunksize` parse option is set, yielding the
+        output of `parse_dataframes` for each chunk as returned by `_read_chunks`. Otherwise, the
+        output of `parse` is yielded as a single chunk.
+
+        Data sources which opt into chunked parsing must be able to parse each chunk independently,
+        since the records of the same key could be split across multiple chunks. Only the first
+        resource is split into chunks, see `DataSource._read_chunks`.
+        """
+        chunksize = parse_opts.get("chunksize")
+        if chunksize is None:
+            yield self.parse(sources, aux, **parse_opts)
+            return
+
+        read_opts = {k: v for k, v in parse_opts.items() if k in READ_OPTS}
+        for dataframes in self._read_chunks(sources, chunksize, **read_opts):
+            yield self.parse_dataframes(dataframes, aux, **parse_opts)
+
     def parse_dataframes(
         self, dataframes: Dict[str, DataFrame], aux: Dict[str, DataFrame], **parse_opts
     ) -> DataFrame:
@@ -97,77 +203,30 @@ class DataSource(ErrorLogger):
         The key must be present in the `aux` DataFrame index.
         """
         # Merge only needs the metadata auxiliary data table
-        metadata = aux["metadata"]
+        key_resolver = self._get_key_resolver(aux["metadata"])
 
         # Exact key match might be possible and it's the fastest option
         if "key" in record and not isna(record["key"]):
-            if record["key"] in metadata["key"].values:
+            if key_resolver.has_key(record["key"]):
                 return record["key"]
             else:
                 self.errlog(f"Key provided but not found in metadata:\n{record}")
                 return None
 
-        # Localities should only be matched using a key directly
-        if "locality_code" in metadata.columns:
-            metadata = metadata[metadata["locality_code"].isna()]
-
-        # Start by filtering the auxiliary dataset as much as possible
-        for column_prefix in ("country", "subregion1", "subregion2"):
-            for column_suffix in ("code", "name"):
-                column = "{}_{}".format(column_prefix, column_suffix)
-                if column not in record:
-                    continue
-                elif isna(record[column]):
-                    metadata = metadata[metadata[column].isna()]
-                elif record[column]:
-                    metadata = metadata[metadata[column] == record[column]]
-
-        # Auxiliary dataset might have a single record left, then we are done
-        if len(metadata) == 1:
-            return metadata.iloc[0]["key"]
-
-        # Compute a fuzzy version of the record's match string for comparison
-        match_string = fuzzy_text(record["match_string"]) if "match_string" in record else None
-
-        # Provided match string could be a subregion code / name
-        if match_string is not None:
-            for column_prefix in ("subregion1", "subregion2"):
-                for column_suffix in ("code", "name"):
-                    column = "{}_{}".format(column_prefix, column_suffix)
-                    aux_match = metadata[column + "_fuzzy"] == match_string
-                    if sum(aux_match) == 1:
-                        return metadata[aux_match].iloc[0]["key"]
-
-        # Provided match string could be identical to `match_string` (or with simple fuzzy match)
-        if match_string is not None:
-            aux_match_1 = metadata["match_string_fuzzy"] == match_string
-            if sum(aux_match_1) == 1:
-                return metadata[aux_match_1].iloc[0]["key"]
-            aux_match_2 = metadata["match_string"] == record["match_string"]
-            if sum(aux_match_2) == 1:
-                return metadata[aux_match_2].iloc[0]["key"]
-
-        # Last resort is to match the `match_string` column with a regex from aux
-        if match_string is not None:
-            aux_mask = ~metadata["match_string"].isna()
-            aux_regex = metadata["match_string"][aux_mask].apply(
-                lambda x: re.compile(x, re.IGNORECASE)
-            )
-            for search_string in (match_string, record["match_string"]):
-                aux_match = aux_regex.apply(lambda x: True if x.match(search_string) else False)
-                if sum(aux_match) == 1:
-                    metadata = metadata[aux_mask]
-                    return metadata[aux_match].iloc[0]["key"]
-
-            # Uncomment when debugging mismatches
-            # print(aux_regex)
-            # print(match_string)
-            # print(record)
-            # print(metadata)
-            # raise ValueError()
-
-        self.errlog(f"No key match found for:\n{record}")
-        return None
+        # Use the indexed metadata to find a match following the usual precedence rules
+        key = key_resolver.resolve(record)
+        if key is None:
+            self.errlog(f"No key match found for:\n{record}")
+        return key
+
+    def _get_key_resolver(self, metadata: DataFrame) -> KeyResolver:
+        """
+        Returns a resolver for the given metadata table, reusing the last one that was built if it
+        corresponds to the same table.
+        """
+        if self._key_resolver is None or self._key_resolver.metadata is not metadata:
+            self._key_resolver = KeyResolver(metadata)
+        return self._key_resolver
 
     def run(
         self,
@@ -175,6 +234,7 @@ class DataSource(ErrorLogger):
         cache: Dict[str, str],
         aux: Dict[str, DataFrame],
         skip_existing: bool = False,
+        key_resolver: KeyResolver = None,
     ) -> DataFrame:
         """
         Executes the fetch, parse and merge steps for this data source.
@@ -184,26 +244,129 @@ class DataSource(ErrorLogger):
             cache: Map of data sources that are stored in the cache layer (used for daily-only).
             aux: Map of auxiliary DataFrames used as part of the processing of this DataSource.
             skip_existing: Flag indicating whether to use the locally stored snapshots if possible.
+            key_resolver: Resolver built from `aux["metadata"]`, shared across data sources to
+                avoid rebuilding the metadata indexes for each one of them.
 
         Returns:
             DataFrame: Processed data, with columns defined in config.yaml corresponding to the
                 DataPipeline that this DataSource is part of.
         """
-        data: DataFrame = None
+        sources = self.run_fetch(output_folder, cache, skip_existing=skip_existing)
+        return self.run_parse(sources, aux, key_resolver=key_resolver)
+
+    def run_fetch(
+        self,
+        output_folder: Path,
+        cache: Dict[str, str],
+        skip_existing: bool = False,
+        fetch_semaphore: threading.Semaphore = None,
+    ) -> Dict[str, str]:
+        """
+        Executes only the fetch step for this data source. See `DataSource.run` for details.
+
+        Args:
+            fetch_semaphore: Semaphore shared with other data sources which bounds the total number
+                of resources being downloaded concurrently.
 
+        Returns:
+            Dict[str, str]: Output of `DataSource.fetch`, which can be passed to `run_parse`.
+        """
         # Insert skip_existing flag to fetch options if requested
         fetch_opts = self.config.get("fetch", [])
         if skip_existing:
             for opt in fetch_opts:
                 opt["opts"] = {**opt.get("opts", {}), "skip_existing": True}
 
-        # Fetch the data, feeding the cached resources to the fetch step
-        data = self.fetch(output_folder, cache, fetch_opts)
+        # Fetch the data, feeding the cached resources to the fetch step; the semaphore is not kept
+        # afterwards, since data sources are sent to worker processes and locks cannot be pickled
+        self._fetch_semaphore = fetch_semaphore
+        try:
+            return self.fetch(output_folder, cache, fetch_opts)
+        finally:
+            self._fetch_semaphore = None
+
+    def run_parse(
+        self, sources: Dict[str, str], aux: Dict[str, DataFrame], key_resolver: KeyResolver = None
+    ) -> DataFrame:
+        """
+        Executes the parse and merge steps for this data source using previously fetched
+        resources. See `DataSource.run` for details. If the `chunksize` parse option is set, the
+        resources are parsed, merged and stratified in chunks; see `DataSource.parse_chunks`.
+
+        Args:
+            sources: Output of `DataSource.run_fetch`.
+
+        Returns:
+            DataFrame: Processed data, same as the output of `DataSource.run`.
+        """
+        if key_resolver is not None:
+            self._key_resolver = key_resolver
 
-        # Make yet another copy of the auxiliary table to avoid affecting future steps in `parse`
+        # Only copy the auxiliary tables used by `parse`, to avoid affecting the merge step
         parse_opts = self.config.get("parse", {})
-        data = self.parse(data, {name: df.copy() for name, df in aux.items()}, **parse_opts)
+        chunks = self.parse_chunks(sources, _CopyOnAccessTables(aux), **parse_opts)
+
+        # Each chunk is merged, filtered and stacked separately so only the processed records of
+        # all the chunks need to be kept in memory at the same time
+        stratified = False
+        has_age = False
+        numeric_columns: List[str] = []
+        processed: List[DataFrame] = []
+        for data in chunks:
+            data = self._merge_keys(data, aux)
+
+            # Filter out data according to the user-provided filter function
+            if "query" in self.config:
+                data = data.query(self.config["query"]).copy()
+
+            # Provide a stratified view of certain key variables
+            if any(stratify_column in data.columns for stratify_column in ("age", "sex")):
+                stratified = True
+                has_age = has_age or "age" in data.columns
+                data = stack_age_sex_ethnicity(data)
+                numeric_columns += [
+                    col
+                    for col in data.columns
+                    if is_numeric_dtype(data[col]) and col not in numeric_columns
+                ]
+
+            processed.append(data)
+
+        chunk_count = len(processed)
+        if chunk_count == 0:
+            return DataFrame(columns=["key"])
+        data = processed[0] if chunk_count == 1 else concat(processed, ignore_index=True)
+        del processed
+
+        # The stacked records of the same key could have been split across chunks, so add up their
+        # numeric columns and keep the first non-null value of the rest
+        if stratified and chunk_count > 1:
+            index_columns = ["key"] + (["date"] if "date" in data.columns else [])
+            value_columns = [col for col in data.columns if col not in index_columns]
+            sum_columns = [col for col in value_columns if col in numeric_columns]
+            first_columns = [col for col in value_columns if col not in numeric_columns]
+            for col in sum_columns:
+                if not is_numeric_dtype(data[col]):
+                    data[col] = data[col].astype(float)
+            grouped = data.groupby(index_columns)
+            data = concat(
+                [grouped[sum_columns].sum(min_count=1), grouped[first_columns].first()], axis=1
+            )
+            data = data[value_columns].reset_index()
+        if has_age:
+            data = rename_age_buckets(data)
 
+        # Process each record to add missing cumsum or daily diffs
+        data = infer_new_and_total(data)
+
+        # Return the final dataframe
+        return data
+
+    def _merge_keys(self, data: DataFrame, aux: Dict[str, DataFrame]) -> DataFrame:
+        """
+        Associates each record of the parsed data with a `key` using `DataSource.merge`, and drops
+        the records which could not be merged.
+        """
         # Merge expects for null values to be NaN (otherwise grouping does not work as expected)
         data.replace([None], numpy.nan, inplace=True)
 
@@ -244,18 +407,4 @@ class DataSource(ErrorLogger):
 
         # Drop records which have no key merged
         # TODO: log records with missing key somewhere on disk
-        data = data.dropna(subset=["key"])
-
-        # Filter out data according to the user-provided filter function
-        if "query" in self.config:
-            data = data.query(self.config["query"]).copy()
-
-        # Provide a stratified view of certain key variables
-        if any(stratify_column in data.columns for stratify_column in ("age", "sex")):
-            data = stratify_age_sex_ethnicity(data)
-
-        # Process each record to add missing cumsum or daily diffs
-        data = infer_new_and_total(data)
-
-        # Return the final dataframe
-        return data
+        return data.dropna(subset=["key"])
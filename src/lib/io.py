@@ -14,19 +14,23 @@
 
 import os
 import re
+import hashlib
 from pathlib import Path
+from functools import lru_cache
 from zipfile import ZipFile
 from contextlib import contextmanager
-from tempfile import TemporaryDirectory
-from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+from io import BytesIO, TextIOWrapper
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Union
 
+import numpy
 import pandas
 from tqdm import tqdm
 from pandas import DataFrame, Int64Dtype
+from pandas.arrays import IntegerArray
 from unidecode import unidecode
 from bs4 import BeautifulSoup, Tag
 
-from .cast import safe_int_cast, column_converters
+from .cast import safe_int_cast, column_casters
 
 # Progress is a global flag, because progress is all done using the tqdm library and can be
 # used within any number of functions but passing a flag around everywhere is cumbersome. Further,
@@ -35,28 +39,83 @@ from .cast import safe_int_cast, column_converters
 GLOBAL_DISABLE_PROGRESS = "TQDM_DISABLE"
 
 
-def fuzzy_text(text: str, remove_regex: str = r"[^a-z\s]", remove_spaces: bool = True):
-    # TODO: handle bad inputs (like empty text)
-    text = unidecode(str(text)).lower()
-    for token in ("y", "and", "of"):
-        text = re.sub(f" {token} ", " ", text)
+# Maximum number of distinct strings whose fuzzy version is kept in memory
+FUZZY_TEXT_CACHE_SIZE = 2 ** 16
+
+# Patterns used by `fuzzy_text`, compiled once and applied in the same order as they appear here
+_FUZZY_TOKEN_PATTERNS = [re.compile(f" {token} ") for token in ("y", "and", "of")]
+_FUZZY_AFFIX_PATTERNS = [
+    re.compile(pattern)
+    for word in ("county", "region", "borough", "province", "department", "district")
+    for pattern in (f"^{word} ", f" {word}$")
+]
+_FUZZY_SPACES_PATTERN = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=FUZZY_TEXT_CACHE_SIZE)
+def _fuzzy_text(text: str, remove_regex: str, remove_spaces: bool) -> str:
+    text = unidecode(text).lower()
+    for pattern in _FUZZY_TOKEN_PATTERNS:
+        text = pattern.sub(" ", text)
     text = re.sub(remove_regex, "", text)
-    text = re.sub(r"^county ", "", text)
-    text = re.sub(r" county$", "", text)
-    text = re.sub(r"^region ", "", text)
-    text = re.sub(r" region$", "", text)
-    text = re.sub(r"^borough ", "", text)
-    text = re.sub(r" borough$", "", text)
-    text = re.sub(r"^province ", "", text)
-    text = re.sub(r" province$", "", text)
-    text = re.sub(r"^department ", "", text)
-    text = re.sub(r" department$", "", text)
-    text = re.sub(r"^district ", "", text)
-    text = re.sub(r" district$", "", text)
-    text = re.sub(r"\s+", "" if remove_spaces else " ", text)
+    for pattern in _FUZZY_AFFIX_PATTERNS:
+        text = pattern.sub("", text)
+    text = _FUZZY_SPACES_PATTERN.sub("" if remove_spaces else " ", text)
     return text.strip()
 
 
+def fuzzy_text(text: str, remove_regex: str = r"[^a-z\s]", remove_spaces: bool = True):
+    # TODO: handle bad inputs (like empty text)
+    return _fuzzy_text(str(text), remove_regex, remove_spaces)
+
+
+def fuzzy_text_series(
+    values: pandas.Series, remove_regex: str = r"[^a-z\s]", remove_spaces: bool = True
+) -> pandas.Series:
+    """
+    Applies `fuzzy_text` to all the values of a series, computing each distinct value only once.
+
+    Arguments:
+        values: Series of values to convert into their fuzzy version.
+        remove_regex: Characters to ignore (and delete), see `fuzzy_text`.
+        remove_spaces: Whether all whitespace should be removed, see `fuzzy_text`.
+    Returns:
+        pandas.Series: Fuzzy version of each value, with the same index as the input.
+    """
+    codes, uniques = pandas.factorize(values)
+    fuzzy = numpy.array(
+        [fuzzy_text(value, remove_regex, remove_spaces) for value in uniques] + [None],
+        dtype=object,
+    )
+    result = fuzzy[codes]
+
+    # Null values are not factorized, but their string representation must be converted too
+    null_mask = codes == -1
+    if null_mask.any():
+        result[null_mask] = [
+            fuzzy_text(value, remove_regex, remove_spaces) for value in values.values[null_mask]
+        ]
+
+    return pandas.Series(result, index=values.index, name=values.name, dtype=object)
+
+
+def file_hash(path: Union[Path, str], block_size: int = 1024 * 1024) -> str:
+    """
+    Computes the SHA-256 hash of the contents of a file, without reading it all into memory.
+
+    Arguments:
+        path: Location on disk of the file
+        block_size: Number of bytes read at a time
+    Returns:
+        str: Hexadecimal representation of the hash
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
 def parse_dtype(dtype_name: str) -> Any:
     """
     Parse a dtype name into its pandas name. Only the following dtypes are supported in
@@ -82,41 +141,98 @@ def parse_dtype(dtype_name: str) -> Any:
     raise TypeError(f"Unsupported dtype: {dtype_name}")
 
 
-def read_file(path: Union[Path, str], **read_opts) -> DataFrame:
-    ext = str(path).split(".")[-1]
+# Known extensions supported by `read_file`
+READ_FILE_EXTENSIONS = ("csv", "json", "html", "xls", "xlsx", "zip")
+
+# Default options used to read CSV and Excel files, which only treat empty cells as null
+_DEFAULT_NA_OPTS = {"keep_default_na": False, "na_values": ["", "N/A"]}
 
-    # Keep a list of known extensions here so we don't forget to update it
-    known_extensions = ("csv", "json", "html", "xls", "xlsx", "zip")
 
+def _read_buffer(path_or_buffer: Union[Path, str, IO], ext: str, **read_opts) -> Any:
+    """ Reads a file path or binary stream using the reader corresponding to `ext` """
     if ext == "csv":
-        return pandas.read_csv(
-            path, **{**{"keep_default_na": False, "na_values": ["", "N/A"]}, **read_opts}
-        )
-    if ext == "json":
-        return pandas.read_json(path, **read_opts)
-    if ext == "html":
-        with open(path, "r") as fd:
-            return read_html(fd.read(), **read_opts)
-    if ext == "xls" or ext == "xlsx":
-        return pandas.read_excel(
-            path, **{**{"keep_default_na": False, "na_values": ["", "N/A"]}, **read_opts}
-        )
+        return pandas.read_csv(path_or_buffer, **{**_DEFAULT_NA_OPTS, **read_opts})
+    if ext == "json" and read_opts.get("lines"):
+        return pandas.read_json(path_or_buffer, **read_opts)
     if ext == "zip":
-        with TemporaryDirectory() as tmpdir:
-            tmpdir = Path(tmpdir)
-            with ZipFile(path, "r") as archive:
-                if "file_name" in read_opts:
-                    file_name = read_opts.pop("file_name")
-                else:
-                    file_name = next(
-                        name
-                        for name in archive.namelist()
-                        if name.rsplit(".", 1)[-1] in known_extensions
-                    )
-                archive.extract(file_name, tmpdir)
-                return read_file(tmpdir / file_name, **read_opts)
-
-    raise ValueError("Unrecognized extension: %s" % ext)
+        return _read_zip(path_or_buffer, **read_opts)
+
+    # The rest of the formats, including JSON documents which are not line-delimited, cannot be
+    # read in chunks so they are read as a single chunk
+    chunksize = read_opts.pop("chunksize", None)
+    if ext == "json":
+        data = pandas.read_json(path_or_buffer, **read_opts)
+    elif ext == "html":
+        if isinstance(path_or_buffer, (Path, str)):
+            with open(path_or_buffer, "r") as fd:
+                data = read_html(fd.read(), **read_opts)
+        else:
+            data = read_html(TextIOWrapper(path_or_buffer).read(), **read_opts)
+    elif ext == "xls" or ext == "xlsx":
+        # Excel readers need to seek within the file, which is very slow for compressed streams
+        if not isinstance(path_or_buffer, (Path, str)):
+            path_or_buffer = BytesIO(path_or_buffer.read())
+        data = pandas.read_excel(path_or_buffer, **{**_DEFAULT_NA_OPTS, **read_opts})
+    else:
+        raise ValueError("Unrecognized extension: %s" % ext)
+
+    return data if chunksize is None else iter([data])
+
+
+def _read_zip_chunks(
+    path_or_buffer: Union[Path, str, IO], file_name: str, **read_opts
+) -> Iterator[DataFrame]:
+    """ Reads an archive member in chunks, keeping the archive open until all chunks are read """
+    with ZipFile(path_or_buffer, "r") as archive:
+        with archive.open(file_name) as fd:
+            yield from _read_buffer(fd, file_name.rsplit(".", 1)[-1], **read_opts)
+
+
+def _read_zip(
+    path_or_buffer: Union[Path, str, IO], file_name: Union[str, List[str]] = None, **read_opts
+) -> Any:
+    """ Reads one or more archive members directly from the archive, see `read_file` """
+    with ZipFile(path_or_buffer, "r") as archive:
+        if file_name is None:
+            file_name = next(
+                name
+                for name in archive.namelist()
+                if name.rsplit(".", 1)[-1] in READ_FILE_EXTENSIONS
+            )
+        file_names = [file_name] if isinstance(file_name, str) else file_name
+
+        # Chunks are read lazily, so each member needs to keep its own handle open
+        if read_opts.get("chunksize") is not None:
+            results = {
+                name: _read_zip_chunks(path_or_buffer, name, **read_opts) for name in file_names
+            }
+        else:
+            results = {}
+            for name in file_names:
+                with archive.open(name) as fd:
+                    results[name] = _read_buffer(fd, name.rsplit(".", 1)[-1], **read_opts)
+
+    return results[file_name] if isinstance(file_name, str) else results
+
+
+def read_file(path: Union[Path, str], **read_opts) -> Any:
+    """
+    Reads a file into a DataFrame using the appropriate reader for its extension. Members of zip
+    archives are read directly from the archive without extracting them to disk.
+
+    Arguments:
+        path: Location of the file to read.
+        read_opts: Options passed to the pandas reader, plus the following:
+            file_name: For zip archives, name of the member to read or a list of names. Defaults
+                to the first member with a known extension.
+            chunksize: Read CSV files and line-delimited JSON files (`lines=True`) in chunks of
+                this many records, in which case an iterator of DataFrames is returned. Other
+                formats are returned as a single chunk.
+    Returns:
+        Any: A DataFrame, an iterator of DataFrames if `chunksize` is given, or a dictionary of
+            <member name, result> if a list of archive members was given.
+    """
+    return _read_buffer(path, str(path).split(".")[-1], **read_opts)
 
 
 def read_lines(path: Path, mode: str = "r", skip_empty: bool = False) -> Iterator[str]:
@@ -145,7 +261,32 @@ def read_table(path: Union[Path, str], schema: Dict[str, Any] = None, **read_opt
     Returns:
         Callable[[Union[Path, str]], DataFrame]: Function like `read_file`
     """
-    return read_file(path, converters=column_converters(schema or {}), **read_opts)
+    schema = schema or {}
+
+    # Read the columns as plain strings and cast them afterwards, which is much faster than
+    # passing converters that are applied to every individual value
+    data = read_file(path, dtype={column: "str" for column in schema.keys()}, **read_opts)
+    if isinstance(data, DataFrame):
+        return cast_table(data, schema)
+    else:
+        return (cast_table(chunk, schema) for chunk in data)
+
+
+def cast_table(data: DataFrame, schema: Dict[str, Any]) -> DataFrame:
+    """
+    Converts the columns of the table which are present in the schema to the appropriate type.
+    This function modifies the input DataFrame in place.
+
+    Arguments:
+        data: DataFrame whose columns will be converted
+        schema: Dictionary of <column, type>
+    Returns:
+        DataFrame: The same DataFrame given as input
+    """
+    for column, caster in column_casters(schema).items():
+        if column in data.columns:
+            data[column] = caster(data[column])
+    return data
 
 
 def _get_html_columns(row: Tag) -> List[Tag]:
@@ -218,9 +359,7 @@ def export_csv(
         path: Location on disk to write the CSV to
     """
     # If a schema is provided, convert all the columns prior to dumping the CSV file
-    for column, converter in column_converters(schema or {}).items():
-        if column in data.columns:
-            data[column] = data[column].apply(converter)
+    cast_table(data, schema or {})
 
     # Path may be None which means output CSV gets returned as a string
     if path is not None:
@@ -231,6 +370,70 @@ def export_csv(
     return data.to_csv(path_or_buf=path, index=False, float_format="%.15G", **csv_opts)
 
 
+def export_npz(data: DataFrame, path: Union[Path, str], schema: Dict[str, Any]) -> None:
+    """
+    Exports the columns of a DataFrame which are part of the schema into a binary file, with one
+    NumPy array per column. Null values are stored as a separate mask for each column, so the
+    table can be read back with its dtypes intact without having to parse any values. String
+    columns are stored as integer codes into an array of their distinct values, since NumPy pads
+    every string in an array to the length of the longest one.
+    Arguments:
+        data: DataFrame to be output, it will not be modified
+        path: Location on disk to write the file to, typically with the `.npz` extension
+        schema: Dictionary of <column, type>, columns not in the schema are not written
+    """
+    arrays: Dict[str, numpy.ndarray] = {}
+    columns = [column for column in schema.keys() if column in data.columns]
+    for column, caster in column_casters({col: schema[col] for col in columns}).items():
+        values = caster(data[column])
+        mask = values.isna().values
+        if schema[column] == "str":
+            values, categories = pandas.factorize(values)
+            arrays[f"{column}/categories"] = numpy.array(categories.astype(str).tolist(), dtype=str)
+        elif schema[column] == "float":
+            values = values.astype(float).values
+        else:
+            values = values.fillna(0).astype("int64").values
+        arrays[f"{column}/values"] = values
+        arrays[f"{column}/mask"] = mask
+
+    # Saving uncompressed is faster, and the columns of intermediate files are mostly numeric
+    with open(path, "wb") as fd:
+        numpy.savez(fd, __columns__=numpy.array(columns, dtype=str), **arrays)
+
+
+def read_npz(path: Union[Path, str], schema: Dict[str, Any] = None) -> DataFrame:
+    """
+    Reads a table written using `export_npz`, restoring null values and dtypes.
+    Arguments:
+        path: Location on disk of the file to read
+        schema: Dictionary of <column, type>, only columns in the schema are read if provided
+    Returns:
+        DataFrame: Table with `str` columns as objects, `float` as floats and `int` as Int64.
+    """
+    data = DataFrame()
+    with numpy.load(path) as archive:
+        columns = archive["__columns__"].tolist()
+        if schema is not None:
+            columns = [col for col in columns if col in schema]
+        for column in columns:
+            values = archive[f"{column}/values"]
+            mask = archive[f"{column}/mask"]
+            if f"{column}/categories" in archive.files:
+                # Null values have a code of -1, which takes the trailing null category
+                categories = archive[f"{column}/categories"].astype(object)
+                values = numpy.append(categories, None).take(values)
+            elif values.dtype.kind == "U":
+                values = values.astype(object)
+                values[mask] = None
+            elif values.dtype.kind == "f":
+                values[mask] = numpy.nan
+            else:
+                values = IntegerArray(values, mask)
+            data[column] = values
+    return data
+
+
 def pbar(*args, **kwargs) -> tqdm:
     """
     Helper function used to display a tqdm progress bar respecting global settings for whether all
@@ -12,22 +12,54 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import csv
 import sys
 import json
+import heapq
 import shutil
-import warnings
 import traceback
 from pathlib import Path
-from typing import Dict, Iterable, List
+from functools import partial
+from itertools import chain
+from contextlib import ExitStack, closing
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from .io import read_lines, read_table
 
 
-# Any CSV file under 50 MB can use the fast JSON converter
-JSON_FAST_CONVERTER_SIZE_BYTES = 50 * 1000 * 1000
+# Number of records read at once when converting a CSV file to JSON
+JSON_CONVERTER_CHUNK_SIZE = 64 * 1024
 
-# Any CSV file above 150 MB should not be converted to JSON
-JSON_MAX_SIZE_BYTES = 150 * 1000 * 1000
+# Size of the buffer used to write the JSON output, so it is written to disk in large blocks
+JSON_WRITE_BUFFER_BYTES = 8 * 1024 * 1024
+
+# Approximate amount of memory used to hold records by the functions which spill them to disk
+SORT_MEMORY_BUDGET_BYTES = 256 * 1000 * 1000
+
+# Maximum number of temporary files merged at once when sorting, to avoid opening too many files
+MERGE_MAX_FAN_IN = 128
+
+
+def _write_lines(path: Path, lines: Iterable[str]) -> None:
+    with open(path, "w") as fd:
+        fd.writelines(lines)
+
+
+def _write_records(path: Path, records: Iterable[List[str]]) -> None:
+    with open(path, "w") as fd:
+        csv.writer(fd).writerows(records)
+
+
+def _read_records(path: Path) -> Iterator[List[str]]:
+    yield from csv.reader(read_lines(path))
+
+
+def _record_size(record: Any) -> int:
+    """ Approximate size in bytes of a record, including the strings held by lists and tuples """
+    if isinstance(record, (list, tuple)):
+        return sys.getsizeof(record) + sum(map(sys.getsizeof, record))
+    return sys.getsizeof(record)
 
 
 def get_table_columns(table_path: Path) -> List[str]:
@@ -45,33 +77,293 @@ def get_table_columns(table_path: Path) -> List[str]:
         return next(reader)
 
 
-def table_sort(table_path: Path, output_path: Path) -> None:
+def _external_sort(
+    records: Iterable[Any],
+    key: Optional[Callable[[Any], Any]],
+    memory_budget: int,
+    write_run: Callable[[Path, Iterable[Any]], None],
+    read_run: Callable[[Path], Iterator[Any]],
+) -> Iterator[Any]:
     """
-    Memory-efficient method used to perform a lexical sort of all the rows of this table, excluding
-    the table header.
+    Sorts the records using at most approximately `memory_budget` bytes of memory. Records are
+    split into runs which fit within the budget, then each run is sorted and written into a
+    temporary file, and finally all runs are merged. Like `sorted`, the sort is stable.
+
+    Arguments:
+        records: Records to be sorted.
+        key: Function used to extract the comparison key from each record.
+        memory_budget: Approximate maximum size in bytes of the records held in memory.
+        write_run: Function used to write an iterable of records into the given path.
+        read_run: Function used to read the records previously written into the given path.
+    Returns:
+        Iterator[Any]: The sorted records.
+    """
+    with TemporaryDirectory() as temp_folder, ExitStack() as stack:
+        run_paths: List[Path] = []
+
+        def write_next_run(run: Iterable[Any]) -> None:
+            run_path = Path(temp_folder) / f"run_{len(run_paths):06d}"
+            write_run(run_path, run)
+            run_paths.append(run_path)
+
+        # Spill the sorted runs into disk unless all records fit within the budget
+        run: List[Any] = []
+        run_size = 0
+        for record in records:
+            run.append(record)
+            run_size += _record_size(record)
+            if run_size >= memory_budget:
+                run.sort(key=key)
+                write_next_run(run)
+                run, run_size = [], 0
+        run.sort(key=key)
+        if not run_paths:
+            yield from run
+            return
+        if run:
+            write_next_run(run)
+        del run
+
+        # Merge the runs in multiple passes if there are too many of them to be open at once
+        while len(run_paths) > MERGE_MAX_FAN_IN:
+            merge_groups = [
+                run_paths[idx : idx + MERGE_MAX_FAN_IN]
+                for idx in range(0, len(run_paths), MERGE_MAX_FAN_IN)
+            ]
+            for group in merge_groups:
+                write_next_run(heapq.merge(*[read_run(path) for path in group], key=key))
+                for path in group:
+                    path.unlink()
+            run_paths = run_paths[-len(merge_groups) :]
+
+        runs = [stack.enter_context(closing(read_run(path))) for path in run_paths]
+        yield from heapq.merge(*runs, key=key)
+
+
+def table_sort(
+    table_path: Path,
+    output_path: Path,
+    sort_columns: List[str] = None,
+    memory_budget: int = SORT_MEMORY_BUDGET_BYTES,
+) -> None:
+    """
+    Memory-efficient method used to sort all the rows of this table, excluding the table header.
+    Rows which do not fit within the memory budget are sorted in runs spilled into temporary files,
+    which are then merged.
 
     Arguments:
         table_path: Path of the table to be sorted.
         output_path: Output location for the sorted table.
+        sort_columns: Columns used to sort the records, parsing each row as CSV. If not provided,
+            a lexical sort of the raw lines is performed instead, which is faster.
+        memory_budget: Approximate maximum size in bytes of the records held in memory.
     """
-    with open(table_path, "r") as fd_in:
-        header = next(fd_in)
+    if sort_columns is None:
+        lines = read_lines(table_path)
+        header = next(lines)
+
+        # Make sure all lines are terminated, so the last one can be placed anywhere
+        lines = (line if line.endswith("\n") else f"{line}\n" for line in lines)
+        with open(output_path, "w") as fd_out:
+            fd_out.write(header)
+            fd_out.writelines(_external_sort(lines, None, memory_budget, _write_lines, read_lines))
+
+    else:
+        reader = csv.reader(read_lines(table_path))
+        columns = next(reader)
+        key_indices = [columns.index(name) for name in sort_columns]
+
+        def sort_key(record: List[str]) -> List[str]:
+            return [record[idx] for idx in key_indices]
+
         with open(output_path, "w") as fd_out:
-            fd_out.write(f"{header}")
+            writer = csv.writer(fd_out)
+            writer.writerow(columns)
+            writer.writerows(
+                _external_sort(reader, sort_key, memory_budget, _write_records, _read_records)
+            )
+
+
+class UnsortedTableError(ValueError):
+    """ Raised by the merge join when one of the input tables is not sorted by the join columns """
+
+
+def _join_indices(columns: Dict[str, int], on: List[str]) -> List[int]:
+    assert all(
+        name in columns.keys() for name in on
+    ), f"Column provided in `on` not present in table. Expected {on} but found {columns}"
+    return [columns[name] for name in on]
 
-            records = []
-            for record in fd_in:
-                records.append(record)
 
-            for record in sorted(records):
-                fd_out.write(f"{record}")
+def _keyed_records(
+    records: Iterable[List[str]], join_indices: List[int], data_indices: List[int]
+) -> Iterator[Tuple[Tuple[str, ...], List[str]]]:
+    """ Splits each record into a tuple with the values of the join columns and the output data """
+    for record in records:
+        yield tuple([record[idx] for idx in join_indices]), [record[idx] for idx in data_indices]
 
 
-def table_join(left: Path, right: Path, on: List[str], output: Path, how: str = "outer") -> None:
+def _hash_join(
+    records_left: Iterable[Tuple[Tuple[str, ...], List[str]]],
+    records_right: Iterable[Tuple[Tuple[str, ...], List[str]]],
+    how: str,
+    empty_right: List[Any],
+) -> Iterator[List[Any]]:
+    """ Joins the records holding all of the right table in memory, see `table_join` """
+    records_right_map = {key: data for key, data in records_right}
+    for key, data_left in records_left:
+        # If this is an inner join and the key is not in the right table, drop it
+        if how == "inner" and not key in records_right_map:
+            continue
+
+        # Get the data from the right table and add it to the left data
+        yield data_left + records_right_map.get(key, empty_right)
+
+
+class _SortedTableLookup:
+    """
+    Finds the records of a table sorted by its join columns for keys given in ascending order,
+    so each record of the table is read only once. If a key is repeated in the table, its last
+    record is used, like in a hash join.
     """
-    Performs a memory efficient left join between two CSV files. The records of the right table
-    are held in memory, so in case of inner joins where order does not matter it is more efficient
-    to pass the bigger table as `left` and smaller one as `right`.
+
+    def __init__(self, records: Iterable[Tuple[Tuple[str, ...], List[str]]], name: str):
+        self._name = name
+        self._records = iter(records)
+        self._key_next, self._data_next = next(self._records, (None, None))
+        self._key_current: Optional[Tuple[str, ...]] = None
+        self._data_current: Optional[List[str]] = None
+
+    def get(self, key: Tuple[str, ...]) -> Optional[List[str]]:
+        """ Returns the data for the given key, which must not be lower than the previous one """
+        if key == self._key_current:
+            return self._data_current
+        if self._key_current is not None and key < self._key_current:
+            raise UnsortedTableError(f"Left table is not sorted: {key} after {self._key_current}")
+
+        # Advance the table up to the given key
+        self._key_current, self._data_current = key, None
+        while self._key_next is not None and self._key_next <= key:
+            if self._key_next == key:
+                self._data_current = self._data_next
+            key_next, self._data_next = next(self._records, (None, None))
+            if key_next is not None and key_next < self._key_next:
+                raise UnsortedTableError(
+                    f"Table {self._name} is not sorted: {key_next} after {self._key_next}"
+                )
+            self._key_next = key_next
+
+        return self._data_current
+
+    def finish(self) -> None:
+        """
+        Reads the rest of the table to make sure that it is sorted, since records after the last
+        key looked up could be out of order and belong to a key looked up before.
+        """
+        while self._key_next is not None:
+            key_next, self._data_next = next(self._records, (None, None))
+            if key_next is not None and key_next < self._key_next:
+                raise UnsortedTableError(
+                    f"Table {self._name} is not sorted: {key_next} after {self._key_next}"
+                )
+            self._key_next = key_next
+
+
+def _merge_join(
+    records_left: Iterable[Tuple[Tuple[str, ...], List[str]]],
+    records_right: Iterable[Tuple[Tuple[str, ...], List[str]]],
+    how: str,
+    empty_right: List[Any],
+) -> Iterator[List[Any]]:
+    """
+    Joins the records by streaming both tables at the same time, which requires both of them to be
+    sorted by the join columns. Raises `UnsortedTableError` if that's not the case.
+    """
+    lookup_right = _SortedTableLookup(records_right, "right")
+    for key_left, data_left in records_left:
+        data_right = lookup_right.get(key_left)
+        if data_right is not None:
+            yield data_left + data_right
+        elif how != "inner":
+            yield data_left + empty_right
+    lookup_right.finish()
+
+
+def _grace_join(
+    records_left: Iterable[Tuple[Tuple[str, ...], List[str]]],
+    records_right: Iterable[Tuple[Tuple[str, ...], List[str]]],
+    how: str,
+    empty_right: List[Any],
+    key_size: int,
+    partition_count: int,
+) -> Iterator[List[Any]]:
+    """
+    Joins the records by splitting both tables into partitions stored on disk, so only one
+    partition of the right table is held in memory at a time. The output is in the same order as
+    the left table. At most `partition_count` files are open at the same time.
+    """
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = Path(temp_folder)
+        paths_left = [temp_folder / f"left_{idx:04d}.csv" for idx in range(partition_count)]
+        paths_right = [temp_folder / f"right_{idx:04d}.csv" for idx in range(partition_count)]
+        paths_output = [temp_folder / f"output_{idx:04d}.csv" for idx in range(partition_count)]
+
+        # Partition both tables by the hash of their key, prepending the position of left records;
+        # one table is partitioned after the other so only one set of partitions is open at once
+        with ExitStack() as stack:
+            writers = [csv.writer(stack.enter_context(open(path, "w"))) for path in paths_right]
+            for key, data in records_right:
+                writers[hash(key) % partition_count].writerow([*key, *data])
+        with ExitStack() as stack:
+            writers = [csv.writer(stack.enter_context(open(path, "w"))) for path in paths_left]
+            for position, (key, data) in enumerate(records_left):
+                writers[hash(key) % partition_count].writerow([position, *key, *data])
+
+        # Join each partition separately, keeping the position of the left records in their data
+        for path_left, path_right, path_output in zip(paths_left, paths_right, paths_output):
+            records_left_part = (
+                (tuple(record[1 : key_size + 1]), [record[0], *record[key_size + 1 :]])
+                for record in _read_records(path_left)
+            )
+            records_right_part = (
+                (tuple(record[:key_size]), record[key_size:])
+                for record in _read_records(path_right)
+            )
+            _write_records(
+                path_output, _hash_join(records_left_part, records_right_part, how, empty_right)
+            )
+            path_left.unlink()
+            path_right.unlink()
+
+        # Merge the output of all partitions using the position of the left records
+        with ExitStack() as stack:
+            readers = [stack.enter_context(closing(_read_records(path))) for path in paths_output]
+            for record in heapq.merge(*readers, key=lambda record: int(record[0])):
+                yield record[1:]
+
+
+def table_join(
+    left: Path,
+    right: Path,
+    on: List[str],
+    output: Path,
+    how: str = "outer",
+    engine: str = "auto",
+    memory_budget: int = SORT_MEMORY_BUDGET_BYTES,
+) -> None:
+    """
+    Performs a memory efficient left join between two CSV files. The output has the same order as
+    the `left` table and, if a key is repeated in the `right` table, its last record is used.
+
+    The join can be performed using one of the following engines:
+    * "merge": streams both tables at the same time, requires them to be sorted by the join columns.
+    * "hash": holds the records of the right table in memory, so in case of inner joins where order
+        does not matter it is more efficient to pass the bigger table as `left`.
+    * "grace": splits both tables into partitions on disk and joins each one separately. There are
+        at most `MERGE_MAX_FAN_IN` partitions to avoid opening too many files, so the partitions
+        of a right table bigger than `MERGE_MAX_FAN_IN` times the memory budget exceed the budget.
+    * "auto": tries "merge" first and, if the tables are not sorted, falls back to "hash" if the
+        right table fits within the memory budget or "grace" otherwise.
 
     Arguments:
         left: Left table to join. Only rows present in this table will be present in the output.
@@ -80,53 +372,126 @@ def table_join(left: Path, right: Path, on: List[str], output: Path, how: str =
         output: Path to write the joined table to.
         how: Either "inner" or "outer" indicating whether records present only in the `left` table
             should be dropped or not.
+        engine: Join engine to use, see above.
+        memory_budget: Approximate size in bytes of the right table which can be held in memory.
     """
+    columns_left = {name: idx for idx, name in enumerate(get_table_columns(left))}
+    columns_right = {name: idx for idx, name in enumerate(get_table_columns(right))}
+    join_indices_left = _join_indices(columns_left, on)
+    join_indices_right = _join_indices(columns_right, on)
+
+    # Only output the data which is not part of the join, which will be added by the left table
+    columns_right_output = {
+        name: idx for name, idx in columns_right.items() if idx not in join_indices_right
+    }
+    columns_output = list(columns_left.keys()) + list(columns_right_output.keys())
+    empty_right = [None] * len(columns_right_output)
+
+    def read_left() -> Iterator[Tuple[Tuple[str, ...], List[str]]]:
+        records = csv.reader(skip_head_reader(left))
+        return _keyed_records(records, join_indices_left, list(columns_left.values()))
+
+    def read_right() -> Iterator[Tuple[Tuple[str, ...], List[str]]]:
+        records = csv.reader(skip_head_reader(right))
+        return _keyed_records(records, join_indices_right, list(columns_right_output.values()))
+
+    # Determine the engines to try in order
+    right_size = right.stat().st_size
+    if engine == "auto":
+        engines = ["merge", "hash" if right_size <= memory_budget else "grace"]
+    elif engine in ("merge", "hash", "grace"):
+        engines = [engine]
+    else:
+        raise ValueError(f"Unknown join engine {engine}")
+
+    for engine_name in engines:
+        if engine_name == "grace":
+            partition_count = max(1, -(-right_size // max(1, memory_budget)))
+            partition_count = min(partition_count, MERGE_MAX_FAN_IN)
+            join_func = partial(_grace_join, key_size=len(on), partition_count=partition_count)
+        else:
+            join_func = _merge_join if engine_name == "merge" else _hash_join
+
+        try:
+            with open(output, "w") as fd_out:
+                writer = csv.writer(fd_out)
+                writer.writerow(columns_output)
+                writer.writerows(join_func(read_left(), read_right(), how, empty_right))
+            return
+        except UnsortedTableError:
+            # Start over with the next engine, unless there are none left
+            if engine_name == engines[-1]:
+                raise
+
+
+def table_multijoin(tables: List[Path], on: List[str], output: Path, how: str = "outer") -> None:
+    """
+    Performs a memory efficient left join of multiple CSV files sorted by the join columns. This is
+    equivalent to joining the first table with each of the other tables in order using
+    `table_join`, but all tables are streamed at the same time in a single pass without writing
+    any intermediate files. Tables other than the first one can be joined using only a prefix of
+    the join columns, for example a table indexed by <key> can be joined with one indexed by
+    <key, date>. Raises `UnsortedTableError` if any of the tables is not sorted, in which case the
+    contents of `output` are not valid.
 
-    def compute_join_indices(columns: List[str]) -> List[str]:
-        assert all(
-            name in columns.keys() for name in on
-        ), f"Column provided in `on` not present in right table. Expected {on} but found {columns}"
-        join_indices = [columns[name] for name in on]
-        return join_indices
-
-    records_right = {}
-    with open(right, "r") as fd:
-        reader = csv.reader(fd)
-        columns_right = {name: idx for idx, name in enumerate(next(reader))}
-        join_indices = compute_join_indices(columns_right)
-
-        # Only save the data which is not part of the join, which will be added by the left table
+    Arguments:
+        tables: Tables to join. Only rows present in the first table will be present in the output.
+        on: Column names to perform the join, all of them must be present in the first table.
+        output: Path to write the joined table to.
+        how: Either "inner" or "outer" indicating whether records not present in all the tables
+            should be dropped or not.
+    """
+    left, rights = tables[0], tables[1:]
+    columns_left = {name: idx for idx, name in enumerate(get_table_columns(left))}
+    join_indices_left = _join_indices(columns_left, on)
+    columns_output = list(columns_left.keys())
+
+    lookups: List[Tuple[int, _SortedTableLookup, List[Any]]] = []
+    for right in rights:
+        columns_right = {name: idx for idx, name in enumerate(get_table_columns(right))}
+        on_right = [name for name in on if name in columns_right]
+        assert on_right and on_right == on[: len(on_right)], (
+            f"Columns of {right} must include a prefix of the join columns. Expected a prefix of "
+            f"{on} but found {list(columns_right.keys())}"
+        )
+
+        # Only output the data which is not part of the join, which will be added by the left table
+        join_indices_right = _join_indices(columns_right, on_right)
         columns_right_output = {
-            name: idx for name, idx in columns_right.items() if idx not in join_indices
+            name: idx for name, idx in columns_right.items() if idx not in join_indices_right
         }
+        columns_output += list(columns_right_output.keys())
 
-        for record in reader:
-            key = tuple([record[idx] for idx in join_indices])
-            data = [record[idx] for idx in columns_right_output.values()]
-            records_right[key] = data
+        records_right = _keyed_records(
+            csv.reader(skip_head_reader(right)),
+            join_indices_right,
+            list(columns_right_output.values()),
+        )
+        lookup = _SortedTableLookup(records_right, str(right))
+        lookups.append((len(on_right), lookup, [None] * len(columns_right_output)))
 
     with open(output, "w") as fd_out:
         writer = csv.writer(fd_out)
-        with open(left, "r") as fd_in:
-            reader = csv.reader(fd_in)
-            columns_left = {name: idx for idx, name in enumerate(next(reader))}
-            join_indices = compute_join_indices(columns_left)
-
-            # Write the output columns as a header
-            columns_output = list(columns_left.keys()) + list(columns_right_output.keys())
-            writer.writerow(columns_output)
-
-            for record_left in reader:
-                key = tuple([record_left[idx] for idx in join_indices])
-                data_left = [record_left[idx] for idx in columns_left.values()]
-
-                # If this is an inner join and the key is not in the right table, drop it
-                if how == "inner" and not key in records_right:
-                    continue
+        writer.writerow(columns_output)
+
+        records_left = _keyed_records(
+            csv.reader(skip_head_reader(left)), join_indices_left, list(columns_left.values())
+        )
+        for key, record in records_left:
+            for prefix_size, lookup, empty_right in lookups:
+                data_right = lookup.get(key[:prefix_size])
+                if data_right is None:
+                    # If this is an inner join and the key is not in this table, drop it
+                    if how == "inner":
+                        break
+                    data_right = empty_right
+                record = record + data_right
+            else:
+                writer.writerow(record)
 
-                # Get the data from the right table and write to output
-                data_right = records_right.get(key, [None] * len(columns_right_output))
-                writer.writerow(data_left + data_right)
+        # Validate the rest of the tables, which were only read up to the last key of the first one
+        for _, lookup, _ in lookups:
+            lookup.finish()
 
 
 def skip_head_reader(path: Path, n: int = 1, **read_opts) -> Iterable[str]:
@@ -136,15 +501,58 @@ def skip_head_reader(path: Path, n: int = 1, **read_opts) -> Iterable[str]:
     yield from fd
 
 
-def table_cross_product(left: Path, right: Path, output: Path) -> None:
+def _serialize_record(record: List[str]) -> Tuple[str, int]:
+    """
+    Serializes a record into a CSV line without line terminator, so it can be concatenated with
+    other records. Returns the serialized record along with its number of fields.
+    """
+    # A record with a single empty field is only quoted when it is the entire line
+    if record == [""]:
+        return "", 1
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(record)
+    return buffer.getvalue()[:-2], len(record)
+
+
+def _concat_records(left: Tuple[str, int], right: Tuple[str, int]) -> str:
+    """ Concatenates two serialized records into a line, same as writing them using `csv.writer` """
+    line = ",".join([text for text, field_count in (left, right) if field_count > 0])
+    if not line and left[1] + right[1] > 0:
+        line = '""'
+    return line + "\r\n"
+
+
+def _read_serialized_blocks(path: Path, block_size: int) -> Iterator[List[Tuple[str, int]]]:
+    """ Reads the serialized records of a table, excluding the header, in blocks of given size """
+    block: List[Tuple[str, int]] = []
+    block_bytes = 0
+    for record in csv.reader(skip_head_reader(path)):
+        block.append(_serialize_record(record))
+        block_bytes += _record_size(block[-1])
+        if block_bytes >= block_size:
+            yield block
+            block, block_bytes = [], 0
+    if block:
+        yield block
+
+
+def table_cross_product(
+    left: Path, right: Path, output: Path, memory_budget: int = SORT_MEMORY_BUDGET_BYTES
+) -> None:
     """
     Memory efficient method to perform the cross product of all columns in two tables. Columns
     which are present in both tables will be duplicated in the output.
 
+    The records of the right table are read only once and kept in memory if they fit within the
+    memory budget. Otherwise, the right table is read in blocks which fit within the budget and the
+    cross product of each block is written into a temporary file, which are then interleaved to
+    preserve the order of the output.
+
     Arguments:
         left: Left table. All columns from this table will be present in the output.
         right: Right table. All columns from this table will be present in the output.
         output: Path to write the joined table to.
+        memory_budget: Approximate maximum size in bytes of the records held in memory.
     """
     columns_left = get_table_columns(left)
     columns_right = get_table_columns(right)
@@ -152,11 +560,35 @@ def table_cross_product(left: Path, right: Path, output: Path) -> None:
         writer = csv.writer(fd)
         writer.writerow(columns_left + columns_right)
 
-        reader_left = csv.reader(skip_head_reader(left))
-        for record_left in reader_left:
-            reader_right = csv.reader(skip_head_reader(right))
-            for record_right in reader_right:
-                writer.writerow(record_left + record_right)
+        blocks_right = _read_serialized_blocks(right, memory_budget)
+        block_first = next(blocks_right, [])
+        block_second = next(blocks_right, None)
+
+        # If the right table fits in memory, it can be used directly for each of the left records
+        if block_second is None:
+            for record_left in csv.reader(skip_head_reader(left)):
+                record_left = _serialize_record(record_left)
+                fd.writelines(_concat_records(record_left, rec) for rec in block_first)
+            return
+
+        with TemporaryDirectory() as temp_folder, ExitStack() as stack:
+            # Write the cross product of each right block with all the left records separately,
+            # prefixing the output of each left record with its length since it spans many lines
+            block_paths = []
+            for block in chain([block_first, block_second], blocks_right):
+                block_paths.append(Path(temp_folder) / f"block_{len(block_paths):06d}.csv")
+                with open(block_paths[-1], "w", newline="") as fd_block:
+                    for record_left in csv.reader(skip_head_reader(left)):
+                        record_left = _serialize_record(record_left)
+                        chunk = "".join(_concat_records(record_left, rec) for rec in block)
+                        fd_block.write(f"{len(chunk)}\n{chunk}")
+
+            # Interleave the output of all blocks, so each left record is followed by all the
+            # records of the right table in order
+            fd_blocks = [stack.enter_context(open(path, "r", newline="")) for path in block_paths]
+            for _ in csv.reader(skip_head_reader(left)):
+                for fd_block in fd_blocks:
+                    fd.write(fd_block.read(int(fd_block.readline())))
 
 
 def table_group_tail(table: Path, output: Path) -> None:
@@ -200,41 +632,37 @@ def convert_csv_to_json_records(
     csv_file: Path,
     output_file: Path,
     skip_size_threshold: int = None,
-    fast_size_threshold: int = None,
+    chunk_size: int = JSON_CONVERTER_CHUNK_SIZE,
 ) -> None:
-
-    if skip_size_threshold is None:
-        skip_size_threshold = JSON_MAX_SIZE_BYTES
-    if fast_size_threshold is None:
-        fast_size_threshold = JSON_FAST_CONVERTER_SIZE_BYTES
-
-    file_size = csv_file.stat().st_size
-    json_coverter_method = _convert_csv_to_json_records_fast
-
-    if skip_size_threshold > 0 and file_size > skip_size_threshold:
-        raise ValueError(f"Size of {csv_file} too large for conversion: {file_size // 1E6} MB")
-
-    if fast_size_threshold > 0 and file_size > fast_size_threshold:
-        warnings.warn(f"Size of {csv_file} too large for fast method: {file_size // 1E6} MB")
-        json_coverter_method = _convert_csv_to_json_records_slow
-
-    json_coverter_method(schema, csv_file, output_file)
-
-
-def _convert_csv_to_json_records_slow(schema: Dict[str, type], csv_file: Path, output_file) -> None:
     """
-    Slow but memory efficient method to convert the provided CSV file to a record-like JSON format
+    Converts the provided CSV file to a record-like JSON format, with the layout
+    `{"columns": [...], "data": [[...], ...]}`. The CSV file is read in chunks which are cast
+    according to the schema and encoded independently, so memory usage is bounded by the chunk
+    size regardless of the size of the file.
+
+    Arguments:
+        schema: Dictionary of <column, type> used to cast the values of the CSV file.
+        csv_file: Path of the CSV file to convert.
+        output_file: Path to write the JSON output to.
+        skip_size_threshold: If provided and greater than zero, files larger than this many bytes
+            are not converted and a `ValueError` is raised instead.
+        chunk_size: Number of records read from the CSV file at once.
     """
+    if skip_size_threshold is not None and skip_size_threshold > 0:
+        file_size = csv_file.stat().st_size
+        if file_size > skip_size_threshold:
+            raise ValueError(f"Size of {csv_file} too large for conversion: {file_size // 1E6} MB")
 
-    with output_file.open("w") as fd_out:
+    with open(output_file, "w", buffering=JSON_WRITE_BUFFER_BYTES) as fd_out:
         # Write the header first
         columns = get_table_columns(csv_file)
-        columns_str = ",".join([f'"{col}"' for col in columns])
-        fd_out.write(f'{{"columns":[{columns_str}],"data":[')
+        fd_out.write(f'{{"columns":{json.dumps(columns, separators=(",", ":"))},"data":[')
 
         # Read the CSV file in chunks but keep only the values
         first_record = True
-        for chunk in read_table(csv_file, schema=schema, chunksize=256):
+        for chunk in read_table(csv_file, schema=schema, chunksize=chunk_size):
+            if len(chunk) == 0:
+                continue
             if first_record:
                 first_record = False
             else:
@@ -242,16 +670,3 @@ def _convert_csv_to_json_records_slow(schema: Dict[str, type], csv_file: Path, o
             fd_out.write(chunk.to_json(orient="values")[1:-1])
 
         fd_out.write("]}")
-
-
-def _convert_csv_to_json_records_fast(
-    schema: Dict[str, type], csv_file: Path, output_file: Path
-) -> None:
-    """
-    Fast but memory intensive method to convert the provided CSV file to a record-like JSON format
-    """
-    table = read_table(csv_file, schema=schema)
-    json_dict = json.loads(table.to_json(orient="split"))
-    del json_dict["index"]
-    with open(output_file, "w") as fd:
-        json.dump(json_dict, fd)
@@ -0,0 +1,271 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import copy
+import pickle
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any, Dict, FrozenSet, List, Optional, Pattern, Tuple, Union
+
+from pandas import DataFrame, isna
+
+from .constants import SRC
+from .io import file_hash, fuzzy_text, fuzzy_text_series, read_file
+
+# Columns which can be used to narrow down the candidate records, in order of precedence
+KEY_FILTER_COLUMNS = [
+    f"{prefix}_{suffix}"
+    for prefix in ("country", "subregion1", "subregion2")
+    for suffix in ("code", "name")
+]
+
+# Columns whose fuzzy version can be matched against the `match_string` of a record
+KEY_FUZZY_COLUMNS = [
+    f"{prefix}_{suffix}" for prefix in ("subregion1", "subregion2") for suffix in ("code", "name")
+]
+
+
+# Folder where the enriched metadata tables and their indexes are cached across processes
+METADATA_CACHE_FOLDER = SRC / ".." / "output" / "cache"
+
+# Version of the cached files, which must be updated whenever `enrich_metadata` or `KeyResolver`
+# change so previously cached files are not used
+METADATA_CACHE_VERSION = 1
+
+# Metadata tables already loaded by this process, keyed by <path, modification time, size>. These
+# are never handed out directly, see `load_metadata`
+_METADATA_MEMO: Dict[Tuple[str, int, int], Tuple[DataFrame, "KeyResolver"]] = {}
+
+
+def _build_index(values: List[Any]) -> Dict[Any, FrozenSet[int]]:
+    index: Dict[Any, List[int]] = {}
+    for idx, value in enumerate(values):
+        if not isna(value):
+            index.setdefault(value, []).append(idx)
+    return {value: frozenset(positions) for value, positions in index.items()}
+
+
+class KeyResolver:
+    """
+    Hash-indexed view of the metadata table used to resolve the `key` of records. It follows the
+    same precedence rules as the original DataFrame filtering implementation of `DataSource.merge`
+    but every lookup is performed using dictionaries of row positions, so it should be built once
+    and reused for all the records being merged.
+    """
+
+    metadata: DataFrame
+    """ Metadata table that this resolver was built from """
+
+    def __init__(self, metadata: DataFrame):
+        self.metadata = metadata
+        self._keys = metadata["key"].tolist()
+        self._key_set = set(self._keys)
+        self._all = frozenset(range(len(metadata)))
+
+        # Localities should only be matched using a key directly
+        if "locality_code" in metadata.columns:
+            self._all = frozenset(
+                idx for idx, value in enumerate(metadata["locality_code"]) if isna(value)
+            )
+
+        # Index all the columns used for filtering, keeping track of null values too
+        self._value_index: Dict[str, Dict[Any, FrozenSet[int]]] = {}
+        self._null_index: Dict[str, FrozenSet[int]] = {}
+        for column in KEY_FILTER_COLUMNS:
+            values = metadata[column].tolist()
+            self._value_index[column] = _build_index(values)
+            self._null_index[column] = frozenset(
+                idx for idx, value in enumerate(values) if isna(value)
+            )
+
+        # The fuzzy columns are typically precomputed by the pipeline, but compute them otherwise
+        self._fuzzy_index: Dict[str, Dict[Any, FrozenSet[int]]] = {}
+        for column in KEY_FUZZY_COLUMNS + ["match_string"]:
+            if f"{column}_fuzzy" in metadata.columns:
+                values = metadata[f"{column}_fuzzy"].tolist()
+            else:
+                values = fuzzy_text_series(metadata[column]).tolist()
+            self._fuzzy_index[column] = _build_index(values)
+        self._match_string_index = _build_index(metadata["match_string"].tolist())
+
+        # The regex table is only compiled the first time it is needed
+        self._regex_table: Optional[List[Tuple[int, Pattern]]] = None
+
+    def _unique(self, candidates: FrozenSet[int], index: Dict[Any, FrozenSet[int]], value: Any):
+        matches = candidates.intersection(index.get(value, ()))
+        return self._keys[next(iter(matches))] if len(matches) == 1 else None
+
+    def _regex_match(self, candidates: FrozenSet[int], search_string: str) -> Optional[str]:
+        if self._regex_table is None:
+            self._regex_table = [
+                (idx, re.compile(value, re.IGNORECASE))
+                for idx, value in enumerate(self.metadata["match_string"])
+                if not isna(value)
+            ]
+        matches = [
+            idx
+            for idx, regex in self._regex_table
+            if idx in candidates and regex.match(search_string)
+        ]
+        return self._keys[matches[0]] if len(matches) == 1 else None
+
+    def has_key(self, key: str) -> bool:
+        """ Returns whether the given key is present in the metadata table """
+        return key in self._key_set
+
+    def resolve(self, record: Dict[str, Any]) -> Optional[str]:
+        """
+        Finds the key corresponding to the given record, without checking for a `key` value in the
+        record itself. See `DataSource.merge` for more details.
+
+        Arguments:
+            record: Record with any of the filter columns and/or a `match_string` value.
+        Returns:
+            Optional[str]: The matching key, or None if no unique match could be found.
+        """
+
+        # Start by filtering the auxiliary dataset as much as possible
+        candidates = self._all
+        for column in KEY_FILTER_COLUMNS:
+            if column not in record:
+                continue
+            elif isna(record[column]):
+                candidates = candidates.intersection(self._null_index[column])
+            elif record[column]:
+                candidates = candidates.intersection(
+                    self._value_index[column].get(record[column], ())
+                )
+
+        # Auxiliary dataset might have a single record left, then we are done
+        if len(candidates) == 1:
+            return self._keys[next(iter(candidates))]
+
+        # Compute a fuzzy version of the record's match string for comparison
+        if "match_string" not in record:
+            return None
+        match_string = fuzzy_text(record["match_string"])
+
+        # Provided match string could be a subregion code / name
+        for column in KEY_FUZZY_COLUMNS:
+            key = self._unique(candidates, self._fuzzy_index[column], match_string)
+            if key is not None:
+                return key
+
+        # Provided match string could be identical to `match_string` (or with simple fuzzy match)
+        key = self._unique(candidates, self._fuzzy_index["match_string"], match_string)
+        if key is not None:
+            return key
+        key = self._unique(candidates, self._match_string_index, record["match_string"])
+        if key is not None:
+            return key
+
+        # Last resort is to match the `match_string` column with a regex from aux
+        for search_string in (match_string, record["match_string"]):
+            key = self._regex_match(candidates, search_string)
+            if key is not None:
+                return key
+
+        return None
+
+
+def enrich_metadata(metadata: DataFrame) -> DataFrame:
+    """
+    Precomputes the fuzzy version of the columns used to match records with keys, which are
+    added to the given metadata table in place.
+
+    Arguments:
+        metadata: Metadata table with at least the `match_string` and filter columns.
+    Returns:
+        DataFrame: The same metadata table with the `*_fuzzy` columns added.
+    """
+    metadata["match_string_fuzzy"] = fuzzy_text_series(metadata.match_string)
+    for category in ("country", "subregion1", "subregion2"):
+        for suffix in ("code", "name"):
+            column = "{}_{}".format(category, suffix)
+            metadata["{}_fuzzy".format(column)] = fuzzy_text_series(metadata[column])
+    return metadata
+
+
+def _read_metadata_cache(cache_path: Path) -> Tuple[DataFrame, KeyResolver]:
+    with open(cache_path, "rb") as fd:
+        return pickle.load(fd)
+
+
+def _write_metadata_cache(cache_path: Path, value: Tuple[DataFrame, KeyResolver]) -> None:
+    # Write to a temporary file first, so concurrent readers never see a partially written file
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile(dir=cache_path.parent, suffix=".tmp", delete=False) as fd:
+        pickle.dump(value, fd, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fd.name, cache_path)
+
+
+def _bind_resolver(resolver: KeyResolver, metadata: DataFrame) -> KeyResolver:
+    """ Shallow copy of `resolver` for a copy of its table, which shares all of its indexes """
+    bound_resolver = copy.copy(resolver)
+    bound_resolver.metadata = metadata
+    return bound_resolver
+
+
+def load_metadata(
+    path: Union[Path, str], cache_folder: Optional[Path] = METADATA_CACHE_FOLDER
+) -> Tuple[DataFrame, KeyResolver]:
+    """
+    Loads the metadata table from the given path after enriching it with `enrich_metadata`, along
+    with a `KeyResolver` built from it. The result is cached in a binary file named after the hash
+    of the source file, so it is only computed once across all processes until the source changes,
+    and it is also kept in memory so all the pipelines within a process load it only once.
+
+    Each caller receives its own copy of the table, which only duplicates the column arrays and not
+    the values in them, so it can be modified without affecting other callers. The resolver is
+    bound to that copy but shares its indexes with the resolvers of all the other callers within
+    the same process, so they are never rebuilt unless the table is replaced.
+
+    Arguments:
+        path: Location of the metadata table.
+        cache_folder: Folder used to cache the enriched table, or None to disable the disk cache.
+    Returns:
+        Tuple[DataFrame, KeyResolver]: The enriched metadata table and its resolver.
+    """
+    path = Path(path)
+    stat = path.stat()
+    memo_key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+    if memo_key in _METADATA_MEMO:
+        metadata, resolver = _METADATA_MEMO[memo_key]
+        metadata = metadata.copy()
+        return metadata, _bind_resolver(resolver, metadata)
+
+    cache_path = None
+    if cache_folder is not None:
+        cache_name = f"{path.stem}.{file_hash(path)}.v{METADATA_CACHE_VERSION}.pickle"
+        cache_path = Path(cache_folder) / cache_name
+
+    value = None
+    if cache_path is not None and cache_path.exists():
+        try:
+            value = _read_metadata_cache(cache_path)
+        except Exception:
+            # A corrupted cache file is simply recomputed below
+            value = None
+
+    if value is None:
+        metadata = enrich_metadata(read_file(path))
+        value = (metadata, KeyResolver(metadata))
+        if cache_path is not None:
+            _write_metadata_cache(cache_path, value)
+
+    _METADATA_MEMO[memo_key] = value
+    metadata = value[0].copy()
+    return metadata, _bind_resolver(value[1], metadata)
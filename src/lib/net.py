@@ -13,13 +13,220 @@
 # limitations under the License.
 
 
+import os
+import json
 import uuid
+import hashlib
+import datetime
+import threading
 from pathlib import Path
-from typing import BinaryIO
+from typing import Any, BinaryIO, Dict, Tuple
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from .io import pbar
 
+# Default number of retries for requests which fail due to connection or server errors
+HTTP_RETRY_COUNT = 3
+
+# Backoff factor between retries, the sleep time is `{backoff} * (2 ** ({retry number} - 1))`
+HTTP_RETRY_BACKOFF = 1.0
+
+# HTTP status codes which are considered transient errors and can be retried
+HTTP_RETRY_STATUS = (500, 502, 503, 504)
+
+# Default timeout for (connect, read) operations, in seconds
+HTTP_TIMEOUT = (30, 300)
+
+# Maximum number of concurrent requests made to the same host within a single process
+HTTP_MAX_CONNECTIONS_PER_HOST = 8
+
+
+class _PooledSession(requests.Session):
+    """
+    Session which applies a default timeout to all requests and limits the number of concurrent
+    requests made to each host. For streamed responses, the slot is held until the response is
+    closed, so callers should close them (for example, using a `with` statement).
+    """
+
+    def __init__(self, timeout: Tuple[float, float], max_connections_per_host: int):
+        super().__init__()
+        self.timeout = timeout
+        self.max_connections_per_host = max_connections_per_host
+        self._host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._host_semaphores_lock = threading.Lock()
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                semaphore = threading.BoundedSemaphore(self.max_connections_per_host)
+                self._host_semaphores[host] = semaphore
+            return self._host_semaphores[host]
+
+    def request(self, method, url, **kwargs):  # pylint: disable=arguments-differ
+        kwargs["timeout"] = kwargs.get("timeout") or self.timeout
+        semaphore = self._host_semaphore(url)
+        semaphore.acquire()
+        try:
+            response = super().request(method, url, **kwargs)
+        except BaseException:
+            semaphore.release()
+            raise
+
+        if not kwargs.get("stream"):
+            semaphore.release()
+        else:
+            release_lock = threading.Lock()
+            response_close = response.close
+
+            def close_and_release():
+                response_close()
+                if release_lock.acquire(blocking=False):
+                    semaphore.release()
+
+            response.close = close_and_release
+        return response
+
+
+_SESSIONS: Dict[Tuple, requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(
+    retries: int = None,
+    backoff: float = None,
+    timeout: Tuple[float, float] = None,
+    max_connections_per_host: int = None,
+) -> requests.Session:
+    """
+    Returns a session shared by all callers within the current process, which keeps connections
+    alive across requests and retries the requests that fail due to transient errors. Sessions are
+    never shared across processes, since the underlying sockets cannot be used after forking.
+
+    Args:
+        retries: Number of retries for connection errors and 5xx responses.
+        backoff: Backoff factor used to compute the sleep time between retries.
+        timeout: Tuple of (connect, read) timeout in seconds applied to every request.
+        max_connections_per_host: Maximum number of concurrent requests made to the same host.
+
+    Returns:
+        requests.Session: Session object to make requests with.
+    """
+    retries = HTTP_RETRY_COUNT if retries is None else retries
+    backoff = HTTP_RETRY_BACKOFF if backoff is None else backoff
+    timeout = HTTP_TIMEOUT if timeout is None else timeout
+    max_connections_per_host = max_connections_per_host or HTTP_MAX_CONNECTIONS_PER_HOST
+
+    session_key = (os.getpid(), retries, backoff, timeout, max_connections_per_host)
+    with _SESSIONS_LOCK:
+        if session_key not in _SESSIONS:
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=HTTP_RETRY_STATUS,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max_connections_per_host)
+            session = _PooledSession(timeout, max_connections_per_host)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSIONS[session_key] = session
+        return _SESSIONS[session_key]
+
+
+# Locks which serialize the downloads into each snapshot path within the current process
+_DOWNLOAD_LOCKS: Dict[Path, threading.Lock] = {}
+_DOWNLOAD_LOCKS_LOCK = threading.Lock()
+
+
+def _download_lock(file_path: Path) -> threading.Lock:
+    """ Lock held while downloading into `file_path` or any of its sidecar files """
+    with _DOWNLOAD_LOCKS_LOCK:
+        return _DOWNLOAD_LOCKS.setdefault(file_path.absolute(), threading.Lock())
+
+
+def _snapshot_metadata_path(file_path: Path) -> Path:
+    """ Path of the sidecar file which stores the metadata of a downloaded snapshot """
+    return file_path.with_name(f"{file_path.name}.meta.json")
+
+
+def _snapshot_partial_path(file_path: Path) -> Path:
+    """ Path where a snapshot is written to until its download has completed """
+    return file_path.with_name(f"{file_path.name}.part")
+
+
+def read_snapshot_metadata(file_path: Path) -> Dict[str, Any]:
+    """
+    Reads the metadata stored alongside a downloaded snapshot, which includes the ETag and
+    Last-Modified headers returned by the server, the SHA-256 hash of the contents and the time
+    when the snapshot was last fetched.
+
+    Args:
+        file_path: Path of the snapshot file.
+
+    Returns:
+        Dict[str, Any]: Metadata of the snapshot, or an empty dict if none is available.
+    """
+    metadata_path = _snapshot_metadata_path(file_path)
+    if not metadata_path.exists():
+        return {}
+    try:
+        with metadata_path.open("r") as fd:
+            return json.load(fd)
+    except ValueError:
+        return {}
+
+
+def _write_snapshot_metadata(file_path: Path, metadata: Dict[str, Any]) -> None:
+    with _snapshot_metadata_path(file_path).open("w") as fd:
+        json.dump(metadata, fd)
+
+
+def _response_validators(response: requests.Response) -> Dict[str, str]:
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+class _HashingWriter:
+    """ Wrapper around a writeable stream which updates a hash with everything written to it """
+
+    def __init__(self, file_handle: BinaryIO, hasher: Any):
+        self.file_handle = file_handle
+        self.hasher = hasher
+
+    def write(self, data: bytes) -> int:
+        self.hasher.update(data)
+        return self.file_handle.write(data)
+
+
+def _update_hash(hasher: Any, file_path: Path) -> None:
+    with file_path.open("rb") as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b""):
+            hasher.update(block)
+
+
+def _utc_timestamp() -> str:
+    return datetime.datetime.utcnow().isoformat()
+
+
+def _write_response(response: requests.Response, file_handle: BinaryIO, progress: bool) -> None:
+    if not progress:
+        for data in response.iter_content(1024 * 1024):
+            file_handle.write(data)
+    else:
+        block_size = 1024
+        total_size = int(response.headers.get("content-length", 0))
+        progress_bar = pbar(total=total_size, unit="iB", unit_scale=True)
+        for data in response.iter_content(block_size):
+            progress_bar.update(len(data))
+            file_handle.write(data)
+        progress_bar.close()
+
 
 def download_snapshot(
     url: str, output_folder: Path, ext: str = None, skip_existing: bool = False, **download_opts
@@ -30,13 +237,18 @@ def download_snapshot(
     reproducibility in downstream processing, which will not require network
     access.
 
+    The ETag and Last-Modified headers of the response are stored in a sidecar metadata file, so
+    subsequent downloads of the same URL are conditional requests which do not transfer the
+    contents again if they have not changed. Interrupted downloads are resumed using range
+    requests when the server supports them.
+
     Args:
         url: URL to download a resource from
         output_folder: Root folder where snapshot, intermediate and tables will be placed.
         ext: Force extension when creating output file, handy when it cannot be guessed from URL.
         skip_existing: If true, skip download and simply return the deterministic path where this
             file would have been downloaded. If the file does not exist, this flag is ignored.
-        download_opts: Keyword arguments passed to the `download` function.
+        download_opts: Keyword arguments passed to the `download_conditional` function.
 
     Returns:
         str: Absolute path where this file was downloaded. This is a deterministic output; the same
@@ -54,13 +266,115 @@ def download_snapshot(
     # Only download the file if skip_existing flag is not present
     # The skip_existing flag is ignored if the file does not already exist
     if not skip_existing or not file_path.exists():
-        with open(file_path, "wb") as file_handle:
-            download(url, file_handle, **download_opts)
+        download_conditional(url, file_path, **download_opts)
 
     # Output the downloaded file path
     return str(file_path.absolute())
 
 
+def download_conditional(
+    url: str, file_path: Path, progress: bool = False, spoof_browser: bool = True
+) -> bool:
+    """
+    Downloads the contents from the provided URL into `file_path`, using the metadata of any
+    previous download to avoid transferring the contents again if they have not changed, and
+    resuming the download of a previously interrupted transfer if possible. Concurrent downloads
+    into the same path within a process wait for each other, since they share the partial download
+    and metadata files.
+
+    Args:
+        url: The endpoint where contents are to be downloaded from
+        file_path: Location on disk to write the contents to
+        progress: Display progress during the download using the lib.utils.pbar function
+        spoof_browser: Pretend to be a web browser by adding user agent string to headers
+
+    Returns:
+        bool: True if new contents were downloaded, False if the existing file was up to date.
+    """
+    with _download_lock(file_path):
+        return _download_conditional(url, file_path, progress, spoof_browser)
+
+
+def _download_conditional(url: str, file_path: Path, progress: bool, spoof_browser: bool) -> bool:
+    """ Implementation of `download_conditional`, which must hold the lock of `file_path` """
+    partial_path = _snapshot_partial_path(file_path)
+    metadata = read_snapshot_metadata(file_path)
+    headers = {"User-Agent": "Safari"} if spoof_browser else {}
+
+    # Ask the server to only send the contents if they changed since the last download
+    if file_path.exists() and metadata.get("etag"):
+        headers["If-None-Match"] = metadata["etag"]
+    if file_path.exists() and metadata.get("last_modified"):
+        headers["If-Modified-Since"] = metadata["last_modified"]
+
+    # Resume an interrupted download if we know which version of the resource it belongs to
+    partial = metadata.get("partial") or {}
+    partial_validator = partial.get("etag") or partial.get("last_modified")
+    offset = partial_path.stat().st_size if partial_path.exists() and partial_validator else 0
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = partial_validator
+
+    restart = False
+    hasher = hashlib.sha256()
+    with get_session().get(url, headers=headers, stream=True) as response:
+        # Resource has not changed since it was last downloaded
+        if response.status_code == 304:
+            if partial_path.exists():
+                partial_path.unlink()
+            _write_snapshot_metadata(
+                file_path, {**metadata, "partial": None, "fetch_time": _utc_timestamp()}
+            )
+            return False
+
+        if response.status_code == 416 and offset > 0:
+            # The range starts at the end of the resource, which means that the download was
+            # interrupted after all of its contents were written; if the partial download does not
+            # match the size of the resource, it cannot be trusted and is downloaded again
+            validators = {key: partial.get(key) for key in ("etag", "last_modified")}
+            if response.headers.get("Content-Range") == f"bytes */{offset}":
+                _update_hash(hasher, partial_path)
+            else:
+                restart = True
+        else:
+            response.raise_for_status()
+
+            # The server may ignore the range request and send the full contents instead
+            content_range = response.headers.get("Content-Range", "")
+            if response.status_code != 206 or not content_range.startswith(f"bytes {offset}-"):
+                offset = 0
+
+            # Record the version of the resource being downloaded so it can be resumed later
+            validators = _response_validators(response)
+            _write_snapshot_metadata(file_path, {**metadata, "partial": validators})
+
+            # Hash the contents as they are written, including any previously downloaded bytes
+            if offset > 0:
+                _update_hash(hasher, partial_path)
+            with partial_path.open("ab" if offset > 0 else "wb") as fd:
+                _write_response(response, _HashingWriter(fd, hasher), progress)
+
+    # Discard the partial download and start over, once the response has been released
+    if restart:
+        partial_path.unlink()
+        _write_snapshot_metadata(file_path, {**metadata, "partial": None})
+        return _download_conditional(url, file_path, progress, spoof_browser)
+
+    # Only replace the snapshot once the download has completed
+    partial_path.replace(file_path)
+    _write_snapshot_metadata(
+        file_path,
+        {
+            "url": url,
+            **validators,
+            "sha256": hasher.hexdigest(),
+            "fetch_time": _utc_timestamp(),
+            "partial": None,
+        },
+    )
+    return True
+
+
 def download(
     url: str, file_handle: BinaryIO, progress: bool = False, spoof_browser: bool = True
 ) -> None:
@@ -76,16 +390,10 @@ def download(
     """
     headers = {"User-Agent": "Safari"} if spoof_browser else {}
     if not progress:
-        req = requests.get(url, headers=headers)
+        req = get_session().get(url, headers=headers)
         req.raise_for_status()
         file_handle.write(req.content)
     else:
-        block_size = 1024
-        req = requests.get(url, headers=headers, stream=True)
-        req.raise_for_status()
-        total_size = int(req.headers.get("content-length", 0))
-        progress_bar = pbar(total=total_size, unit="iB", unit_scale=True)
-        for data in req.iter_content(block_size):
-            progress_bar.update(len(data))
-            file_handle.write(data)
-        progress_bar.close()
+        with get_session().get(url, headers=headers, stream=True) as req:
+            req.raise_for_status()
+            _write_response(req, file_handle, progress)
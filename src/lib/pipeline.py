@@ -12,37 +12,162 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import csv
+import json
 import uuid
+import heapq
+import hashlib
 import importlib
+import threading
 import traceback
 from pathlib import Path
 from functools import partial
+from contextlib import ExitStack
+from tempfile import TemporaryDirectory
 from multiprocessing import cpu_count
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import yaml
-import requests
-from pandas import DataFrame
+import numpy
+from pandas import DataFrame, MultiIndex, concat
 
-from .anomaly import detect_anomaly_all, detect_stale_columns
-from .cast import column_converters
+from .anomaly import REPORT_COLUMNS, detect_anomaly_all, detect_stale_columns_by_key
+from .cast import column_casters
 from .constants import SRC, CACHE_URL
-from .concurrent import process_map
-from .data_source import DataSource
+from .concurrent import SharedObject, process_map, thread_map
+from .data_source import DataSource, DEFAULT_FETCH_CONCURRENCY
 from .error_logger import ErrorLogger
-from .io import read_file, read_table, fuzzy_text, export_csv, parse_dtype, pbar
+from .io import read_file, read_table, read_npz, export_csv, export_npz
+from .io import file_hash, parse_dtype, pbar
+from .metadata import KeyResolver, load_metadata
+from .net import get_session
 from .utils import combine_tables, drop_na_records, filter_output_columns
 
 
+# Keys of the data source configs which do not affect their output, so they are ignored when
+# deciding whether previous intermediate or combined results can be reused
+CONFIG_INVARIANT_KEYS = ("test", "automation", "fetch_concurrency")
+
+
+def _output_config(data_source: DataSource) -> Dict[str, Any]:
+    """ Config of a data source without the keys which do not affect its output """
+    cfg = data_source.config
+    return {key: val for key, val in cfg.items() if key not in CONFIG_INVARIANT_KEYS}
+
+
 def _gen_intermediate_name(data_source: DataSource) -> str:
     data_source_class = data_source.__class__
-    cfg = data_source.config
-    config_invariant = ("test", "automation")
-    data_source_config = str({key: val for key, val in cfg.items() if key not in config_invariant})
+    data_source_config = str(_output_config(data_source))
     source_full_name = f"{data_source_class.__module__}.{data_source_class.__name__}"
     return uuid.uuid5(uuid.NAMESPACE_DNS, f"{source_full_name}.{data_source_config}")
 
 
+# Formats supported for the intermediate results, as <extension, (export function, read function)>.
+# The binary format keeps the dtypes and avoids parsing, CSV is mostly useful for debugging.
+INTERMEDIATE_FORMATS: Dict[str, Tuple[Callable, Callable]] = {
+    "csv": (export_csv, read_table),
+    "npz": (export_npz, read_npz),
+}
+
+
+def _gen_fetch_manifest_path(output_folder: Path, data_source: DataSource) -> Path:
+    return output_folder / "snapshot" / f"{_gen_intermediate_name(data_source)}.fetch.json"
+
+
+class DataPipelineConfig:
+    """
+    Lightweight description of a data pipeline, which only parses its `config.yaml`. It provides
+    everything needed to list the pipelines and their data sources without importing any of the
+    data source modules or loading the auxiliary tables, which only happens when calling `load`.
+    """
+
+    name: str
+    """ The name of the pipeline """
+
+    table: str
+    """ The name of the table corresponding to the pipeline """
+
+    schema: Dict[str, Any]
+    """ Names and corresponding dtypes of output columns """
+
+    auxiliary: Dict[str, Path]
+    """ Paths of the auxiliary datasets passed to the data sources, keyed by name """
+
+    source_configs: List[Dict[str, Any]]
+    """ Config of each data source, including the defaults applied by the pipeline """
+
+    def __init__(self, name: str, config_yaml: Dict[str, Any]):
+        self.name = name
+        self.table = name.replace("_", "-")
+
+        # The pipeline's schema and auxiliary tables are part of the config
+        self.schema = {name: parse_dtype(dtype) for name, dtype in config_yaml["schema"].items()}
+        self.auxiliary = {
+            name: SRC / path for name, path in config_yaml.get("auxiliary", {}).items()
+        }
+
+        # Maximum number of concurrent downloads across all data sources, which they can lower
+        self.fetch_concurrency = config_yaml.get("fetch_concurrency", DEFAULT_FETCH_CONCURRENCY)
+
+        self.source_configs = []
+        for idx, source_config in enumerate(config_yaml["sources"]):
+            # Add the job group to all configs
+            source_config["automation"] = source_config.get("automation", {})
+            source_config["automation"]["job_group"] = source_config["automation"].get(
+                "job_group", str(idx)
+            )
+
+            # Apply the pipeline's fetch concurrency limit to all configs
+            source_config["fetch_concurrency"] = min(
+                source_config.get("fetch_concurrency", self.fetch_concurrency),
+                self.fetch_concurrency,
+            )
+
+            self.source_configs.append(source_config)
+
+    @staticmethod
+    def read(name: str) -> "DataPipelineConfig":
+        """
+        Reads the configuration of a data pipeline at the expected path from the given name.
+
+        Arguments:
+            name: Name of the data pipeline, which is the same as the name of the output table but
+                replacing underscores (`_`) with dashes (`-`).
+        Returns:
+            DataPipelineConfig: The configuration of the data pipeline.
+        """
+        config_path = SRC / "pipelines" / name / "config.yaml"
+        with open(config_path, "r") as fd:
+            return DataPipelineConfig(name, yaml.safe_load(fd))
+
+    def load(self) -> "DataPipeline":
+        """
+        Imports the data sources of this pipeline and creates the corresponding DataPipeline.
+
+        Returns:
+            DataPipeline: The DataPipeline object corresponding to this configuration.
+        """
+        data_sources = []
+        for source_config in self.source_configs:
+            # Use reflection to create an instance of the corresponding DataSource class
+            module_tokens = source_config["name"].split(".")
+            class_name = module_tokens[-1]
+            module_name = ".".join(module_tokens[:-1])
+            module = importlib.import_module(module_name)
+
+            # Create the DataSource class with the appropriate config
+            data_sources.append(getattr(module, class_name)(source_config))
+
+        return DataPipeline(
+            self.name,
+            self.schema,
+            self.auxiliary,
+            data_sources,
+            fetch_concurrency=self.fetch_concurrency,
+        )
+
+
 class DataPipeline(ErrorLogger):
     """
     A data pipeline is a collection of individual [DataSource]s which produce a full table ready
@@ -65,39 +190,53 @@ class DataPipeline(ErrorLogger):
     data_sources: List[DataSource]
     """ List of data sources (initialized with the appropriate config) executed in order """
 
-    auxiliary_tables: Dict[str, DataFrame]
+    auxiliary: Dict[str, Path]
+    """ Paths of the auxiliary datasets, which are only loaded when they are first needed """
+
+    fetch_concurrency: int
+    """ Maximum number of resources downloaded concurrently across all data sources """
+
+    _auxiliary_tables: Optional[Dict[str, DataFrame]] = None
     """ Auxiliary datasets passed to the pipelines during processing """
 
+    _key_resolver: Optional[KeyResolver] = None
+    """ Index of the metadata table used by the data sources to merge their records """
+
     def __init__(
         self,
         name: str,
         schema: Dict[str, type],
         auxiliary: Dict[str, Union[Path, str]],
         data_sources: List[DataSource],
+        fetch_concurrency: int = DEFAULT_FETCH_CONCURRENCY,
     ):
         super().__init__()
         self.name = name
         self.schema = schema
         self.data_sources = data_sources
+        self.fetch_concurrency = fetch_concurrency
         self.table = name.replace("_", "-")
 
         # Metadata table can be overridden but must always be present
-        auxiliary = {"metadata": SRC / "data" / "metadata.csv", **auxiliary}
-
-        # Load the auxiliary tables into memory
-        aux = {name: read_file(table) for name, table in auxiliary.items()}
-
-        # Precompute some useful transformations in the auxiliary input files
-        aux["metadata"]["match_string_fuzzy"] = aux["metadata"].match_string.apply(fuzzy_text)
-        for category in ("country", "subregion1", "subregion2"):
-            for suffix in ("code", "name"):
-                column = "{}_{}".format(category, suffix)
-                aux["metadata"]["{}_fuzzy".format(column)] = aux["metadata"][column].apply(
-                    fuzzy_text
-                )
-
-        # Set this instance's auxiliary tables to our precomputed tables
-        self.auxiliary_tables = aux
+        self.auxiliary = {"metadata": SRC / "data" / "metadata.csv", **auxiliary}
+
+    @property
+    def auxiliary_tables(self) -> Dict[str, DataFrame]:
+        """ Auxiliary datasets passed to the pipelines during processing, loaded on first use """
+        if self._auxiliary_tables is None:
+            # Load the auxiliary tables into memory, the metadata table is cached with its
+            # precomputed transformations and index since it is shared by all pipelines
+            aux: Dict[str, DataFrame] = {}
+            for name, table in self.auxiliary.items():
+                if name == "metadata":
+                    aux[name], self._key_resolver = load_metadata(table)
+                else:
+                    aux[name] = read_file(table)
+
+            # Set this instance's auxiliary tables to our precomputed tables
+            self._auxiliary_tables = aux
+
+        return self._auxiliary_tables
 
     @staticmethod
     def load(name: str) -> "DataPipeline":
@@ -110,33 +249,7 @@ class DataPipeline(ErrorLogger):
         Returns:
             DataPipeline: The DataPipeline object corresponding to the input name.
         """
-        # Read config from the yaml file
-        config_path = SRC / "pipelines" / name / "config.yaml"
-        with open(config_path, "r") as fd:
-            config_yaml = yaml.safe_load(fd)
-
-        # The pipeline's schema and auxiliary tables are part of the config
-        schema = {name: parse_dtype(dtype) for name, dtype in config_yaml["schema"].items()}
-        auxiliary = {name: SRC / path for name, path in config_yaml.get("auxiliary", {}).items()}
-
-        data_sources = []
-        for idx, source_config in enumerate(config_yaml["sources"]):
-            # Add the job group to all configs
-            source_config["automation"] = source_config.get("automation", {})
-            source_config["automation"]["job_group"] = source_config["automation"].get(
-                "job_group", str(idx)
-            )
-
-            # Use reflection to create an instance of the corresponding DataSource class
-            module_tokens = source_config["name"].split(".")
-            class_name = module_tokens[-1]
-            module_name = ".".join(module_tokens[:-1])
-            module = importlib.import_module(module_name)
-
-            # Create the DataSource class with the appropriate config
-            data_sources.append(getattr(module, class_name)(source_config))
-
-        return DataPipeline(name, schema, auxiliary, data_sources)
+        return DataPipelineConfig.read(name).load()
 
     def output_table(self, data: DataFrame) -> DataFrame:
         """
@@ -149,10 +262,10 @@ class DataPipeline(ErrorLogger):
         output_columns = list(self.schema.keys())
 
         # Make sure all columns are present and have the appropriate type
-        for column, converter in column_converters(self.schema).items():
+        for column, caster in column_casters(self.schema).items():
             if column not in data:
                 data[column] = None
-            data[column] = data[column].apply(converter)
+            data[column] = caster(data[column])
 
         # Filter only output columns and output the sorted data
         return drop_na_records(data[output_columns], ["date", "key"]).sort_values(output_columns)
@@ -161,12 +274,13 @@ class DataPipeline(ErrorLogger):
     def _run_wrapper(
         output_folder: Path,
         cache: Dict[str, str],
-        aux: Dict[str, DataFrame],
+        shared_aux: SharedObject,
         data_source: DataSource,
     ) -> Optional[DataFrame]:
         """ Workaround necessary for multiprocess pool, which does not accept lambda functions """
         try:
-            return data_source.run(output_folder, cache, aux)
+            aux, key_resolver = shared_aux.obj
+            return data_source.run(output_folder, cache, aux, key_resolver=key_resolver)
         except Exception:
             data_source_name = data_source.__class__.__name__
             data_source.errlog(
@@ -175,6 +289,450 @@ class DataPipeline(ErrorLogger):
             traceback.print_exc()
         return None
 
+    def _get_key_resolver(self) -> KeyResolver:
+        """ Returns the index of the metadata table, rebuilding it if the table was replaced """
+        metadata = self.auxiliary_tables["metadata"]
+        if self._key_resolver.metadata is not metadata:
+            self._key_resolver = KeyResolver(metadata)
+        return self._key_resolver
+
+    def _read_cache_sitemap(self) -> Dict[str, str]:
+        """ Reads the cache directory from our cloud storage """
+        try:
+            return get_session().get("{}/sitemap.json".format(CACHE_URL)).json()
+        except:
+            self.errlog("Cache unavailable")
+            return {}
+
+    @staticmethod
+    def _fetch_wrapper(
+        output_folder: Path,
+        cache: Dict[str, str],
+        fetch_semaphore: threading.Semaphore,
+        data_source: DataSource,
+    ) -> Optional[Dict[str, str]]:
+        """ Fetches the resources of a data source and persists the paths where they were stored """
+        try:
+            sources = data_source.run_fetch(output_folder, cache, fetch_semaphore=fetch_semaphore)
+            with open(_gen_fetch_manifest_path(output_folder, data_source), "w") as fd:
+                # Store as a list of pairs, since the names can also be ordinal numbers
+                json.dump(list(sources.items()), fd)
+            return sources
+        except Exception:
+            data_source_name = data_source.__class__.__name__
+            data_source.errlog(
+                f"Error fetching data source {data_source_name} with config {data_source.config}"
+            )
+            traceback.print_exc()
+        return None
+
+    @staticmethod
+    def _parse_wrapper(
+        output_folder: Path,
+        schema: Dict[str, Any],
+        intermediate_format: str,
+        shared_aux: SharedObject,
+        data_source: DataSource,
+    ) -> bool:
+        """
+        Parses the previously fetched resources of a data source and saves the intermediate result
+        directly from the worker, so it does not need to be sent back to the parent process.
+        """
+        try:
+            with open(_gen_fetch_manifest_path(output_folder, data_source), "r") as fd:
+                sources = {name: path for name, path in json.load(fd)}
+            aux, key_resolver = shared_aux.obj
+            result = data_source.run_parse(sources, aux, key_resolver=key_resolver)
+            export_func, _ = INTERMEDIATE_FORMATS[intermediate_format]
+            file_name = f"{_gen_intermediate_name(data_source)}.{intermediate_format}"
+            export_func(result, output_folder / "intermediate" / file_name, schema=schema)
+            return True
+        except Exception:
+            data_source_name = data_source.__class__.__name__
+            data_source.errlog(
+                f"Error parsing data source {data_source_name} with config {data_source.config}"
+            )
+            traceback.print_exc()
+        return False
+
+    def run_fetch(self, output_folder: Path, thread_count: int = cpu_count() * 4) -> None:
+        """
+        Performs only the fetch step for each of the data sources in this pipeline, using a pool of
+        threads since it is an I/O bound task. The paths of the fetched resources are persisted
+        in the "snapshot" folder, so `run_parse` can be executed later, possibly elsewhere.
+
+        Arguments:
+            output_folder: Root path of the outputs where "snapshot", "intermediate" and "tables"
+                will be created and populated with CSV files.
+            thread_count: Maximum number of data sources being fetched in parallel.
+        """
+        (output_folder / "snapshot").mkdir(parents=True, exist_ok=True)
+
+        # All data sources draw from the same download slots, so the total number of concurrent
+        # downloads is bounded by the pipeline's fetch concurrency regardless of `thread_count`
+        fetch_semaphore = threading.BoundedSemaphore(self.fetch_concurrency)
+        map_func = partial(
+            DataPipeline._fetch_wrapper, output_folder, self._read_cache_sitemap(), fetch_semaphore
+        )
+
+        data_sources_count = len(self.data_sources)
+        progress_label = f"Fetch {self.name} pipeline"
+        if thread_count <= 1 or data_sources_count <= 1:
+            map_result = pbar(
+                map(map_func, self.data_sources), total=data_sources_count, desc=progress_label
+            )
+        else:
+            map_result = thread_map(
+                map_func, self.data_sources, max_workers=thread_count, desc=progress_label
+            )
+
+        # Consume the results
+        _ = list(map_result)
+
+    def run_parse(
+        self,
+        output_folder: Path,
+        process_count: int = cpu_count(),
+        intermediate_format: str = "npz",
+    ) -> None:
+        """
+        Performs only the parse step for each of the data sources in this pipeline, using the
+        resources previously fetched by `run_fetch`, and saves the intermediate results. This is a
+        CPU bound task, so it uses a pool of processes.
+
+        Arguments:
+            output_folder: Root path of the outputs where "snapshot", "intermediate" and "tables"
+                will be created and populated with CSV files.
+            process_count: Maximum number of processes to run in parallel.
+            intermediate_format: File format used to store the intermediate results.
+        """
+        (output_folder / "intermediate").mkdir(parents=True, exist_ok=True)
+
+        # Share the auxiliary tables and the metadata index with workers, see `DataPipeline.parse`
+        key_resolver = self._get_key_resolver()
+        with SharedObject((self.auxiliary_tables, key_resolver)) as shared_aux:
+            map_func = partial(
+                DataPipeline._parse_wrapper,
+                output_folder,
+                self.schema,
+                intermediate_format,
+                shared_aux,
+            )
+
+            data_sources_count = len(self.data_sources)
+            progress_label = f"Parse {self.name} pipeline"
+            if process_count <= 1 or data_sources_count <= 1:
+                map_result = pbar(
+                    map(map_func, self.data_sources), total=data_sources_count, desc=progress_label
+                )
+            else:
+                map_result = process_map(
+                    map_func,
+                    self.data_sources,
+                    max_workers=process_count,
+                    max_tasks_per_child=1,
+                    desc=progress_label,
+                )
+
+            # Consume the results
+            _ = list(map_result)
+
+    def _index_columns(self) -> List[str]:
+        """ Columns which uniquely identify each record of the output table """
+        return [col for col in ("date", "key") if col in self.schema]
+
+    def run_combine(
+        self,
+        output_folder: Path,
+        intermediate_format: str = "npz",
+        force: bool = False,
+        incremental: bool = True,
+    ) -> Optional[Path]:
+        """
+        Combines the intermediate results saved by `run_parse` and writes the output table into
+        the "tables" folder. The hashes of the intermediate files are stored alongside the table,
+        and the combine step is skipped if none of them have changed since the last time, unless the
+        schema or the configs of the data sources changed.
+
+        The records contributed by each intermediate file are also stored alongside the table, so
+        when only some of the intermediate files change, only the records indexed by the <date,
+        key> pairs present in the old or new version of those files are combined again and spliced
+        into the previous table. See `DataPipeline._combine_incremental` for details.
+
+        Arguments:
+            output_folder: Root path of the outputs where "snapshot", "intermediate" and "tables"
+                will be created and populated with CSV files.
+            intermediate_format: File format used to store the intermediate results.
+            force: Combine all the intermediate results even if they have not changed.
+            incremental: Only combine the records affected by the intermediate results which
+                changed, if the outputs of a previous combine step are available.
+        Returns:
+            Optional[Path]: Location of the combined table, or None if the combine step was skipped.
+        """
+        intermediate_folder = output_folder / "intermediate"
+        tables_folder = output_folder / "tables"
+        tables_folder.mkdir(parents=True, exist_ok=True)
+        table_path = tables_folder / f"{self.table}.csv"
+        inputs_path = tables_folder / f"{self.table}.inputs.json"
+        provenance_path = tables_folder / f"{self.table}.provenance.npz"
+
+        # Compute the hashes of all the intermediate files available, preserving the source order
+        input_hashes: Dict[str, str] = {}
+        for data_source in self.data_sources:
+            file_name = f"{_gen_intermediate_name(data_source)}.{intermediate_format}"
+            if (intermediate_folder / file_name).exists():
+                input_hashes[file_name] = file_hash(intermediate_folder / file_name)
+
+        # Read the state of the previous combine step, if any, which is only valid if it was
+        # produced using the same schema and data source configs
+        fingerprint = self._combine_fingerprint()
+        previous_hashes: Optional[Dict[str, str]] = None
+        if not force and table_path.exists() and inputs_path.exists():
+            with open(inputs_path, "r") as fd:
+                previous_inputs = json.load(fd)
+            if previous_inputs.get("fingerprint") == fingerprint:
+                previous_hashes = previous_inputs.get("inputs")
+            if previous_hashes is not None:
+                if list(previous_hashes.items()) == list(input_hashes.items()):
+                    return None
+
+        # Incremental combine is only possible if the order of the unchanged sources is the same
+        # and the output table is sorted by its index columns, so records can be spliced into it
+        previous_hashes = previous_hashes or {}
+        unchanged = [
+            name for name, value in input_hashes.items() if previous_hashes.get(name) == value
+        ]
+        index_columns = self._index_columns()
+        can_increment = (
+            incremental
+            and len(previous_hashes) > 0
+            and provenance_path.exists()
+            and [name for name in previous_hashes if name in unchanged] == unchanged
+            and sorted(list(self.schema.keys())[: len(index_columns)]) == sorted(index_columns)
+        )
+        previous_provenance = self._read_provenance(provenance_path) if can_increment else {}
+        if any(name not in previous_provenance for name in unchanged):
+            can_increment = False
+
+        if not can_increment:
+            intermediate_results = list(
+                self._load_intermediate_results(
+                    intermediate_folder, self.data_sources, intermediate_format=intermediate_format
+                )
+            )
+            pipeline_output = self.combine(intermediate_results)
+            export_csv(pipeline_output, table_path, schema=self.schema)
+
+            # Keep track of the <date, key> pairs contributed by each one of the intermediate files
+            provenance: Dict[str, DataFrame] = {}
+            for data_source, result in intermediate_results:
+                file_name = f"{_gen_intermediate_name(data_source)}.{intermediate_format}"
+                provenance[file_name] = result[index_columns].dropna().drop_duplicates()
+
+        else:
+            provenance = self._combine_incremental(
+                table_path,
+                intermediate_folder,
+                intermediate_format,
+                {name: previous_provenance[name] for name in unchanged},
+                previous_provenance,
+            )
+
+        # Only keep track of the intermediate files which could be read, and persist the state
+        # needed for the next incremental combine
+        input_hashes = {name: value for name, value in input_hashes.items() if name in provenance}
+        self._write_provenance(provenance_path, provenance)
+        with open(inputs_path, "w") as fd:
+            json.dump({"fingerprint": fingerprint, "inputs": input_hashes}, fd)
+
+        return table_path
+
+    def _combine_fingerprint(self) -> str:
+        """ Hash of the schema and data source configs, which affect the output of `combine` """
+        state = {
+            "schema": {name: str(dtype) for name, dtype in self.schema.items()},
+            "sources": [_output_config(data_source) for data_source in self.data_sources],
+        }
+        state_json = json.dumps(state, sort_keys=True, default=str)
+        return hashlib.sha256(state_json.encode("utf-8")).hexdigest()
+
+    def _combine_incremental(
+        self,
+        table_path: Path,
+        intermediate_folder: Path,
+        intermediate_format: str,
+        unchanged: Dict[str, DataFrame],
+        previous_provenance: Dict[str, DataFrame],
+    ) -> Dict[str, DataFrame]:
+        """
+        Combines only the records indexed by the <date, key> pairs contributed by the changed or
+        removed intermediate files, either in their old or new version, and splices them into the
+        previous output table. Since records are combined independently for each <date, key> pair,
+        the result is the same as combining all the intermediate results again.
+
+        Only the changed intermediate files and the unchanged ones which contributed any of the
+        affected records are read, and the previous output is streamed instead of parsed.
+
+        Arguments:
+            table_path: Location of the output table, which is updated in place.
+            intermediate_folder: Folder containing the intermediate files.
+            intermediate_format: File format used to store the intermediate results.
+            unchanged: <date, key> pairs contributed by each intermediate file which did not change.
+            previous_provenance: <date, key> pairs contributed by each intermediate file to the
+                previous output table.
+        Returns:
+            Dict[str, DataFrame]: The <date, key> pairs contributed by each intermediate file which
+                could be read to the new output table.
+        """
+        index_columns = self._index_columns()
+        file_names = {
+            data_source: f"{_gen_intermediate_name(data_source)}.{intermediate_format}"
+            for data_source in self.data_sources
+        }
+        available = [
+            data_source
+            for data_source, file_name in file_names.items()
+            if (intermediate_folder / file_name).exists()
+        ]
+
+        # Read the changed intermediate files first, to find out all the affected records
+        changed_sources = [ds for ds in available if file_names[ds] not in unchanged]
+        changed_results: Dict[str, DataFrame] = {
+            file_names[data_source]: result
+            for data_source, result in self._load_intermediate_results(
+                intermediate_folder, changed_sources, intermediate_format=intermediate_format
+            )
+        }
+        provenance = {
+            name: result[index_columns].dropna().drop_duplicates()
+            for name, result in changed_results.items()
+        }
+        changed = [name for name in previous_provenance if name not in unchanged]
+        affected = [previous_provenance[name] for name in changed if name in previous_provenance]
+        affected += list(provenance.values())
+        affected = [index for index in affected if len(index) > 0]
+
+        # Keep the provenance of all the files which could be read in the order of the data sources
+        provenance = {**unchanged, **provenance}
+        provenance = {
+            file_names[ds]: provenance[file_names[ds]]
+            for ds in available
+            if file_names[ds] in provenance
+        }
+        if not affected:
+            return provenance
+
+        affected_index = MultiIndex.from_frame(concat(affected).astype(str).drop_duplicates())
+
+        # Combine all records for the affected <date, key> pairs, preserving the source order and
+        # reading only the unchanged files which contributed any of them
+        affected_results = []
+        for data_source in available:
+            name = file_names[data_source]
+            if name in changed_results:
+                result = changed_results[name]
+            elif name in unchanged:
+                if not MultiIndex.from_frame(unchanged[name]).isin(affected_index).any():
+                    continue
+                loaded = list(
+                    self._load_intermediate_results(
+                        intermediate_folder, [data_source], intermediate_format=intermediate_format
+                    )
+                )
+                if not loaded:
+                    provenance.pop(name, None)
+                    continue
+                result = loaded[0][1]
+            else:
+                continue
+            result_index = MultiIndex.from_frame(result[index_columns].astype(str))
+            affected_results.append((data_source, result[result_index.isin(affected_index)]))
+
+        if affected_results:
+            affected_output = self.combine(affected_results)
+        else:
+            affected_output = self.output_table(DataFrame(columns=self.schema.keys()))
+
+        self._splice_table(table_path, affected_output, set(affected_index.tolist()))
+        return provenance
+
+    def _splice_table(self, table_path: Path, records: DataFrame, replaced: Set[Tuple]) -> None:
+        """
+        Replaces the records of the output table indexed by any of the `replaced` <date, key>
+        pairs with the given records, streaming the output table so it is never fully loaded.
+        Both the output table and `records` must be sorted as done by `output_table`.
+        """
+        sort_columns = list(self.schema.keys())[: len(self._index_columns())]
+        index_columns = self._index_columns()
+
+        with TemporaryDirectory(dir=table_path.parent) as temp_folder:
+            records_path = Path(temp_folder) / "records.csv"
+            export_csv(records, records_path, schema=self.schema)
+            output_path = Path(temp_folder) / "output.csv"
+
+            with ExitStack() as stack:
+                reader_previous = csv.reader(stack.enter_context(open(table_path, newline="")))
+                reader_records = csv.reader(stack.enter_context(open(records_path, newline="")))
+                columns = next(reader_previous)
+                next(reader_records)
+                positions_sort = [columns.index(col) for col in sort_columns]
+                positions_index = [columns.index(col) for col in index_columns]
+
+                # Null values are sorted last, and written as empty strings
+                sort_key = lambda x: [(x[idx] == "", x[idx]) for idx in positions_sort]
+                records_previous = (
+                    record
+                    for record in reader_previous
+                    if tuple(record[idx] for idx in positions_index) not in replaced
+                )
+
+                fd_out = stack.enter_context(open(output_path, "w", newline=""))
+                writer = csv.writer(fd_out, lineterminator=os.linesep)
+                writer.writerow(columns)
+                writer.writerows(heapq.merge(records_previous, reader_records, key=sort_key))
+
+            os.replace(output_path, table_path)
+
+    def _read_provenance(self, path: Path) -> Dict[str, DataFrame]:
+        """ Reads the <date, key> pairs contributed by each intermediate file to the output """
+        provenance: Dict[str, DataFrame] = {}
+        index_columns = self._index_columns()
+        with numpy.load(path) as archive:
+            for name in archive["__files__"].tolist():
+                provenance[name] = DataFrame(
+                    {col: archive[f"{name}/{col}"].astype(object) for col in index_columns}
+                )
+        return provenance
+
+    def _write_provenance(self, path: Path, provenance: Dict[str, DataFrame]) -> None:
+        """ Writes the <date, key> pairs contributed by each intermediate file to the output """
+        arrays: Dict[str, numpy.ndarray] = {}
+        for name, index in provenance.items():
+            for col in self._index_columns():
+                arrays[f"{name}/{col}"] = numpy.array(index[col].astype(str).tolist(), dtype=str)
+        with open(path, "wb") as fd:
+            numpy.savez(fd, __files__=numpy.array(list(provenance.keys()), dtype=str), **arrays)
+
+    def run_verify(
+        self, output_folder: Path, level: str = "simple", process_count: int = cpu_count()
+    ) -> DataFrame:
+        """
+        Performs the verification step on the table written by `run_combine`.
+
+        Arguments:
+            output_folder: Root path of the outputs where "snapshot", "intermediate" and "tables"
+                will be created and populated with CSV files.
+            level: Level of anomaly detection to perform, see `DataPipeline.verify`.
+            process_count: Maximum number of processes to run in parallel.
+        Returns:
+            DataFrame: The verified table, the anomalies found are written next to it.
+        """
+        pipeline_output = read_table(output_folder / "tables" / f"{self.table}.csv", self.schema)
+        report_path = output_folder / "tables" / f"{self.table}.anomalies.json"
+        return self.verify(
+            pipeline_output, level=level, process_count=process_count, report_path=report_path
+        )
+
     def parse(
         self, output_folder: Path, process_count: int = cpu_count()
     ) -> Iterable[Tuple[DataSource, DataFrame]]:
@@ -191,30 +749,37 @@ class DataPipeline(ErrorLogger):
         """
 
         # Read the cache directory from our cloud storage
-        try:
-            cache = requests.get("{}/sitemap.json".format(CACHE_URL)).json()
-        except:
-            cache = {}
-            self.errlog("Cache unavailable")
-
-        # Make a copy of the auxiliary table to prevent modifying it for everyone, but this way
-        # we allow for local modification (which might be wanted for optimization purposes)
-        aux_copy = {name: df.copy() for name, df in self.auxiliary_tables.items()}
-
-        # Create a function to be used during mapping. The nestedness is an unfortunate outcome of
-        # the multiprocessing module's limitations when dealing with lambda functions, coupled with
-        # the "sandboxing" we implement to ensure resiliency.
-        map_func = partial(DataPipeline._run_wrapper, output_folder, cache, aux_copy)
-
-        # If the process count is less than one, run in series (useful to evaluate performance)
-        data_sources_count = len(self.data_sources)
-        progress_label = f"Run {self.name} pipeline"
-        if process_count <= 1 or data_sources_count <= 1:
-            map_result = pbar(
-                map(map_func, self.data_sources), total=data_sources_count, desc=progress_label
-            )
-        else:
-            map_result = process_map(map_func, self.data_sources, desc=progress_label)
+        cache = self._read_cache_sitemap()
+
+        # Index the metadata table once so all data sources can reuse it to merge their records
+        key_resolver = self._get_key_resolver()
+
+        # Share the auxiliary tables with all workers instead of sending a copy to each one of them.
+        # Forked workers read the parent's memory directly, and each worker only runs a single data
+        # source so any local modification (which might be wanted for optimization purposes) only
+        # affects that data source. Tables used by `parse` are copied, see `DataSource.run_parse`.
+        with SharedObject((self.auxiliary_tables, key_resolver)) as shared_aux:
+
+            # Create a function to be used during mapping. The nestedness is an unfortunate outcome
+            # of the multiprocessing module's limitations when dealing with lambda functions,
+            # coupled with the "sandboxing" we implement to ensure resiliency.
+            map_func = partial(DataPipeline._run_wrapper, output_folder, cache, shared_aux)
+
+            # If the process count is less than one, run in series (useful to evaluate performance)
+            data_sources_count = len(self.data_sources)
+            progress_label = f"Run {self.name} pipeline"
+            if process_count <= 1 or data_sources_count <= 1:
+                map_result = pbar(
+                    map(map_func, self.data_sources), total=data_sources_count, desc=progress_label
+                )
+            else:
+                map_result = process_map(
+                    map_func,
+                    self.data_sources,
+                    max_workers=process_count,
+                    max_tasks_per_child=1,
+                    desc=progress_label,
+                )
 
         # Get all the pipeline outputs
         # This operation is parallelized but output order is preserved
@@ -247,8 +812,20 @@ class DataPipeline(ErrorLogger):
         # Return data using the pipeline's output parameters
         return self.output_table(pipeline_output)
 
+    @staticmethod
+    def _verify_wrapper(
+        schema: Dict[str, Any], name: str, shared_data: SharedObject, bounds: Tuple[int, int]
+    ) -> DataFrame:
+        """ Performs stale column detection for all the keys within the given slice of records """
+        start, end = bounds
+        return detect_stale_columns_by_key(schema, shared_data.obj.iloc[start:end], [name])
+
     def verify(
-        self, pipeline_output: DataFrame, level: str = "simple", process_count: int = cpu_count()
+        self,
+        pipeline_output: DataFrame,
+        level: str = "simple",
+        process_count: int = cpu_count(),
+        report_path: Path = None,
     ) -> DataFrame:
         """
         Perform verification tasks on the data pipeline combined outputs.
@@ -258,33 +835,58 @@ class DataPipeline(ErrorLogger):
             process_count: Maximum number of processes to run in parallel.
             verify_level: Level of anomaly detection to perform on outputs. Possible values are:
                 None, "simple" and "full".
+            report_path: Location of a JSON file where the anomalies found are written, as a list
+                of records with the columns described in `lib.anomaly.REPORT_COLUMNS`.
         Returns:
             DataFrame: same as `pipeline_output`.
 
         """
+        reports = []
 
         # Skip anomaly detection unless requested
         if level == "simple":
 
             # Validate that the table looks good
-            detect_anomaly_all(self.schema, pipeline_output, [self.name])
+            reports.append(detect_anomaly_all(self.schema, pipeline_output, [self.name]))
 
         if level == "full":
 
-            # Perform stale column detection for each known key
-            map_iter = pipeline_output.key.unique()
-            # TODO: convert into a regular function since lambdas cannot be pickled
-            map_func = lambda key: detect_stale_columns(
-                self.schema, pipeline_output[pipeline_output.key == key], (self.name, key)
-            )
-            progress_label = f"Verify {self.name} pipeline"
-            if process_count <= 1 or len(map_iter) <= 1:
-                map_func = pbar(map(map_func, map_iter), total=len(map_iter), desc=progress_label)
-            else:
-                map_func = process_map(map_func, map_iter, desc=progress_label)
-
-            # Consume the results
-            _ = list(map_func)
+            # Sort the records by key once, so each partition is a contiguous slice of whole keys
+            data = pipeline_output.sort_values("key", kind="mergesort").reset_index(drop=True)
+            keys = data.key.values
+            key_starts = numpy.flatnonzero(numpy.append(True, keys[1:] != keys[:-1]))
+            key_starts = key_starts if len(data) > 0 else key_starts[:0]
+
+            # Use several partitions per process, so the work is evenly distributed
+            partition_count = max(1, min(len(key_starts), process_count * 4))
+            partition_starts = [
+                starts[0]
+                for starts in numpy.array_split(key_starts, partition_count)
+                if len(starts) > 0
+            ]
+            map_iter = list(zip(partition_starts, partition_starts[1:] + [len(data)]))
+
+            # Perform stale column detection for each known key within each partition
+            with SharedObject(data) as shared_data:
+                map_func = partial(
+                    DataPipeline._verify_wrapper, self.schema, self.name, shared_data
+                )
+                progress_label = f"Verify {self.name} pipeline"
+                if process_count <= 1 or len(map_iter) <= 1:
+                    map_result = pbar(
+                        map(map_func, map_iter), total=len(map_iter), desc=progress_label
+                    )
+                else:
+                    map_result = process_map(
+                        map_func, map_iter, max_workers=process_count, desc=progress_label
+                    )
+
+                # Consume the results
+                reports.extend(map_result)
+
+        if report_path is not None:
+            report = concat(reports, ignore_index=True) if reports else DataFrame()
+            report.reindex(columns=REPORT_COLUMNS).to_json(report_path, orient="records")
 
         return pipeline_output
 
@@ -292,23 +894,28 @@ class DataPipeline(ErrorLogger):
         self,
         intermediate_folder: Path,
         intermediate_results: Iterable[Tuple[DataSource, DataFrame]],
+        intermediate_format: str = "npz",
     ) -> None:
+        export_func, _ = INTERMEDIATE_FORMATS[intermediate_format]
         for data_source, result in intermediate_results:
             if result is not None:
-                file_name = f"{_gen_intermediate_name(data_source)}.csv"
-                export_csv(result, intermediate_folder / file_name, schema=self.schema)
+                file_name = f"{_gen_intermediate_name(data_source)}.{intermediate_format}"
+                export_func(result, intermediate_folder / file_name, schema=self.schema)
             else:
                 data_source_name = data_source.__class__.__name__
                 self.errlog(f"No output for {data_source_name} with config {data_source.config}")
 
     def _load_intermediate_results(
-        self, intermediate_folder: Path, data_sources: Iterable[DataSource]
+        self,
+        intermediate_folder: Path,
+        data_sources: Iterable[DataSource],
+        intermediate_format: str = "npz",
     ) -> Iterable[Tuple[DataSource, DataFrame]]:
-
+        _, read_func = INTERMEDIATE_FORMATS[intermediate_format]
         for data_source in data_sources:
-            intermediate_path = intermediate_folder / f"{_gen_intermediate_name(data_source)}.csv"
+            file_name = f"{_gen_intermediate_name(data_source)}.{intermediate_format}"
             try:
-                yield (data_source, read_table(intermediate_path, self.schema))
+                yield (data_source, read_func(intermediate_folder / file_name, self.schema))
             except Exception as exc:
                 data_source_name = data_source.__class__.__name__
                 self.errlog(
@@ -317,7 +924,11 @@ class DataPipeline(ErrorLogger):
                 )
 
     def run(
-        self, output_folder: Path, process_count: int = cpu_count(), verify_level: str = "simple"
+        self,
+        output_folder: Path,
+        process_count: int = cpu_count(),
+        verify_level: str = "simple",
+        intermediate_format: str = "npz",
     ) -> DataFrame:
         """
         Main method which executes all the associated [DataSource] objects and combines their
@@ -329,20 +940,24 @@ class DataPipeline(ErrorLogger):
             process_count: Maximum number of processes to run in parallel.
             verify_level: Level of anomaly detection to perform on outputs. Possible values are:
                 None, "simple" and "full".
+            intermediate_format: File format used to store the intermediate results. Possible
+                values are "npz" (default) and "csv", which is slower but easier to inspect.
         Returns:
             DataFrame: Processed and combined outputs from all the individual data sources into a
                 single table.
         """
-        # TODO: break out fetch & parse steps
-        intermediate_results = self.parse(output_folder, process_count=process_count)
+        # Fetch all the resources first, since it's I/O bound and can use many more workers
+        self.run_fetch(output_folder)
 
-        # Save all intermediate results (to allow for reprocessing)
-        intermediate_folder = output_folder / "intermediate"
-        self._save_intermediate_results(intermediate_folder, intermediate_results)
+        # Parse the fetched resources and save the intermediate results (to allow reprocessing)
+        self.run_parse(
+            output_folder, process_count=process_count, intermediate_format=intermediate_format
+        )
 
         # Re-load all intermediate results
+        intermediate_folder = output_folder / "intermediate"
         intermediate_results = self._load_intermediate_results(
-            intermediate_folder, self.data_sources
+            intermediate_folder, self.data_sources, intermediate_format=intermediate_format
         )
 
         # Combine all intermediate results into a single dataframe
@@ -14,13 +14,18 @@
 
 from functools import partial, reduce
 from typing import Any, Callable, List, Dict, Tuple, Optional
+import numpy
 from numpy import unique
-from pandas import DataFrame, Series, concat, isna, merge
+from pandas import DataFrame, MultiIndex, Series, concat, isna, merge
 from pandas.api.types import is_numeric_dtype
-from .cast import safe_int_cast
+from .cast import safe_int_cast, safe_int_cast_series
 from .io import fuzzy_text, pbar, tqdm
 
 
+# Prefix of the stratified age columns, since it's less obvious from the value names
+AGE_PREFIX = "age_"
+
+
 def get_or_default(dict_like: Dict, key: Any, default: Any):
     return dict_like[key] if key in dict_like and not isna(dict_like[key]) else default
 
@@ -89,12 +94,11 @@ def agg_last_not_null(series: Series, progress_bar: Optional[tqdm] = None) -> Se
     return reduce(lambda x, y: y if not isna(y) else x, series)
 
 
-def combine_tables(
-    tables: List[DataFrame], keys: List[str], progress_label: str = None
+def _combine_tables_reference(
+    data: DataFrame, keys: List[str], progress_label: str = None
 ) -> DataFrame:
-    """ Combine a list of tables, keeping the last non-null value for every column """
-    data = concat(tables)
-    grouped = data.groupby([col for col in keys if col in data.columns])
+    """ Reference implementation of `combine_tables` which reduces each group in Python """
+    grouped = data.groupby(keys)
     if not progress_label:
         return grouped.aggregate(agg_last_not_null).reset_index()
     else:
@@ -108,12 +112,101 @@ def combine_tables(
         return combined
 
 
+def _combine_tables_columnar(
+    data: DataFrame, keys: List[str], progress_label: str = None
+) -> DataFrame:
+    """
+    Vectorized implementation of `combine_tables`. Grouping preserves the relative order of the
+    rows within each group, so `GroupBy.last` (which skips nulls) yields the last non-null value
+    of every column in the order the tables were provided.
+    """
+    grouped = data.groupby(keys, sort=True)
+    value_columns = [col for col in data.columns if col not in keys]
+    if progress_label:
+        value_columns = pbar(value_columns, desc=f"Combine {progress_label} outputs")
+
+    # Build the output from the group index so tables with only key columns are also supported
+    combined = DataFrame(index=grouped.size().index)
+    for column in value_columns:
+        combined[column] = grouped[column].last()
+    return combined.reset_index()
+
+
+COMBINE_ENGINES: Dict[str, Callable] = {
+    "columnar": _combine_tables_columnar,
+    "reference": _combine_tables_reference,
+}
+
+
+def combine_tables(
+    tables: List[DataFrame], keys: List[str], progress_label: str = None, engine: str = "columnar"
+) -> DataFrame:
+    """
+    Combine a list of tables, keeping the last non-null value for every column
+
+    Args:
+        tables: Tables to combine, values from latter tables take precedence over earlier ones
+        keys: Columns used to index the records
+        progress_label: Label of the progress bar, no progress is displayed if not provided
+        engine: Either "columnar" (default), which uses vectorized grouping operations, or
+            "reference", which reduces each group with `agg_last_not_null`
+
+    Returns:
+        DataFrame: Single table with one record per unique combination of `keys`
+    """
+    if engine not in COMBINE_ENGINES:
+        raise ValueError(f"Unknown combine engine {engine}")
+    data = concat(tables, ignore_index=True)
+    keys = [col for col in keys if col in data.columns]
+    return COMBINE_ENGINES[engine](data, keys, progress_label=progress_label)
+
+
 def drop_na_records(table: DataFrame, keys: List[str], inplace: bool = False) -> DataFrame:
     """ Drops all records which have no data outside of the provided keys """
     value_columns = [col for col in table.columns if not col in keys]
     return table.dropna(subset=value_columns, how="all", inplace=inplace)
 
 
+def _grouped_apply(
+    data: DataFrame,
+    keys: List[str],
+    kernel: Callable[[DataFrame, List[str], List[str]], DataFrame],
+    skip: List[str] = None,
+    prefix: Tuple[str, str] = None,
+) -> DataFrame:
+    """
+    Sorts the data by `keys` and applies the given kernel to all the value columns which have at
+    least one non-null value. See `grouped_transform` for more details about the arguments.
+
+    Args:
+        data: The DataFrame to which transformations will be applied to
+        keys: Columns to group the data by before applying the transformation
+        kernel: Function which receives the sorted data, the columns to group it by and the columns
+            to transform, and returns a DataFrame with the transformed columns
+        skip: Columns which should be kept as-is and not transformed
+        prefix: Tuple used as a prefix for the name of the new transformed columns
+
+    Returns:
+        DataFrame: Data after the given transformation is applied to the relevant columns.
+    """
+    assert keys[-1] == "date", '"date" key should be last'
+
+    data = data.sort_values(keys)
+    skip = [] if skip is None else skip
+    prefix = ("", "") if prefix is None else prefix
+    value_columns = [column for column in data.columns if column not in keys + skip]
+
+    # Columns with no values at all are left untouched
+    not_null = data[value_columns].notna()
+    transform_columns = [column for column in value_columns if not_null[column].any()]
+    transformed = kernel(data, keys[:-1], transform_columns)
+    for column in transform_columns:
+        data[prefix[0] + column.replace(prefix[1], "")] = transformed[column]
+
+    # Drop the records with no values, which was deferred to avoid copying the sorted table
+    return data[not_null.any(axis=1).values]
+
+
 def grouped_transform(
     data: DataFrame,
     keys: List[str],
@@ -136,30 +229,40 @@ def grouped_transform(
     Returns:
         DataFrame: Data after the given transformation is applied to the relevant columns.
     """
-    assert keys[-1] == "date", '"date" key should be last'
 
-    # Keep a copy of the columns that will not be transformed
-    data = data.sort_values(keys)
-    skip = [] if skip is None else skip
-    data_skipped = {col: data[col].copy() for col in skip if col in data}
+    def _kernel(data: DataFrame, group_keys: List[str], columns: List[str]) -> DataFrame:
+        group = data.groupby(group_keys)
+        return DataFrame({column: group[column].apply(transform) for column in columns})
 
-    group = data.groupby(keys[:-1])
-    prefix = ("", "") if prefix is None else prefix
-    value_columns = [column for column in data.columns if column not in keys + skip]
+    return _grouped_apply(data, keys, _kernel, skip=skip, prefix=prefix)
 
-    data = data.dropna(subset=value_columns, how="all").copy()
-    for column in value_columns:
-        if column in skip:
-            continue
-        if data[column].isnull().all():
-            continue
-        data[prefix[0] + column.replace(prefix[1], "")] = group[column].apply(transform)
 
-    # Restore the columns that were not transformed
-    for name, col in data_skipped.items():
-        data[name] = col
+def _group_boundaries(data: DataFrame, group_keys: List[str]) -> Tuple[Series, Series]:
+    """
+    Returns masks for the first record of each group and for records with a null group key, which
+    are not part of any group. Assumes that `data` is sorted by `group_keys`.
+    """
+    key_values = data[group_keys]
+    first = (key_values != key_values.shift()).any(axis=1)
+    return first, key_values.isna().any(axis=1)
 
-    return data
+
+def _diff_kernel(data: DataFrame, group_keys: List[str], columns: List[str]) -> DataFrame:
+    """ Vectorized equivalent of `ffill().diff()` within each group for all `columns` at once """
+    first, null_keys = _group_boundaries(data, group_keys)
+    filled = data.groupby(group_keys)[columns].ffill()
+    result = filled - filled.shift()
+    result.loc[(first | null_keys).values] = numpy.nan
+    return result
+
+
+def _cumsum_kernel(data: DataFrame, group_keys: List[str], columns: List[str]) -> DataFrame:
+    """ Vectorized equivalent of `fillna(0).cumsum()` within each group for all `columns` """
+    _, null_keys = _group_boundaries(data, group_keys)
+    filled = data[columns].fillna(0)
+    result = filled.groupby([data[key] for key in group_keys]).cumsum()
+    result.loc[null_keys.values] = numpy.nan
+    return result
 
 
 def grouped_diff(
@@ -168,7 +271,8 @@ def grouped_diff(
     skip: List[str] = None,
     prefix: Tuple[str, str] = ("new_", "total_"),
 ) -> DataFrame:
-    return grouped_transform(data, keys, lambda x: x.ffill().diff(), skip=skip, prefix=prefix)
+    """ Computes `ffill().diff()` for each value column within the groups of `keys[:-1]` """
+    return _grouped_apply(data, keys, _diff_kernel, skip=skip, prefix=prefix)
 
 
 def grouped_cumsum(
@@ -177,7 +281,8 @@ def grouped_cumsum(
     skip: List[str] = None,
     prefix: Tuple[str, str] = ("total_", "new_"),
 ) -> DataFrame:
-    return grouped_transform(data, keys, lambda x: x.fillna(0).cumsum(), skip=skip, prefix=prefix)
+    """ Computes `fillna(0).cumsum()` for each value column within the groups of `keys[:-1]` """
+    return _grouped_apply(data, keys, _cumsum_kernel, skip=skip, prefix=prefix)
 
 
 def stack_table(
@@ -211,18 +316,27 @@ def stack_table(
     stash_output = data[stash_columns].copy()
     data = data.drop(columns=stash_columns)
 
-    # Aggregate (stack) columns with respect to the value columns
+    # Aggregate (stack) all the value columns at once for each of the stack columns, which yields
+    # a column for each <value column, stack value> pair named "{value column}_{stack value}"
+    stacked_tables = []
     for col_stack in stack_columns:
         col_stack_values = data[col_stack].dropna().unique()
-        for col_variable in value_columns:
-            df = data[index_columns + [col_variable, col_stack]].copy()
-            df = df.pivot_table(
-                values=col_variable, index=index_columns, columns=[col_stack], aggfunc="sum"
-            )
-            column_mapping = {suffix: f"{col_variable}_{suffix}" for suffix in col_stack_values}
-            df = df.rename(columns=column_mapping)
-            transfer_columns = list(column_mapping.values())
-            output[transfer_columns] = df[transfer_columns]
+        if len(value_columns) == 0 or len(col_stack_values) == 0:
+            continue
+        df = data.groupby(index_columns + [col_stack])[value_columns].sum().unstack(col_stack)
+        transfer_pairs = [(col, suffix) for col in value_columns for suffix in col_stack_values]
+        df = df.reindex(index=output.index, columns=MultiIndex.from_tuples(transfer_pairs))
+        df.columns = [f"{col_variable}_{suffix}" for col_variable, suffix in transfer_pairs]
+        stacked_tables.append(df)
+
+    # Transfer all the stacked columns into the output at once, overwriting existing columns
+    if stacked_tables:
+        stacked = concat(stacked_tables, axis=1)
+        stacked = stacked.loc[:, ~stacked.columns.duplicated(keep="last")]
+        overwrite_columns = [col for col in stacked.columns if col in output.columns]
+        for col in overwrite_columns:
+            output[col] = stacked[col]
+        output = concat([output, stacked.drop(columns=overwrite_columns)], axis=1)
 
     # Restore the stashed columns, reset index and return
     output[stash_columns] = stash_output
@@ -301,6 +415,17 @@ def stratify_age_sex_ethnicity(data: DataFrame) -> DataFrame:
     an input table might have columns [key, date, population, sex] and this function would produce
     the output [key, date, population, population_male, population_female].
     """
+    has_age = "age" in data.columns
+    data = stack_age_sex_ethnicity(data)
+    return rename_age_buckets(data) if has_age else data
+
+
+def stack_age_sex_ethnicity(data: DataFrame) -> DataFrame:
+    """
+    First step of `stratify_age_sex_ethnicity`, which stacks the age, sex and ethnicity columns.
+    The stacked tables of disjoint subsets of records can be combined by adding them together, but
+    age columns are not renamed until `rename_age_buckets` is called.
+    """
 
     # This function is only called as part of the pipeline processing, so we can assume that:
     # 1. All records with no key have been discarded by now
@@ -313,50 +438,52 @@ def stratify_age_sex_ethnicity(data: DataFrame) -> DataFrame:
         col for col in data.columns if col not in candidate_columns and is_numeric_dtype(data[col])
     ]
 
-    age_prefix = "age_"
-    has_age = "age" in data.columns
-    if has_age:
+    if "age" in data.columns:
 
         # If a data source reports too many age buckets, compress all those > 90
-        data.loc[
-            data["age"].apply(lambda x: (safe_int_cast(str(x).split("-")[-1]) or 0) > 90), "age"
-        ] = "90-"
+        age_upper_bound = safe_int_cast_series(data["age"].astype(str).str.split("-").str[-1])
+        data.loc[(age_upper_bound.fillna(0) > 90).astype(bool).values, "age"] = "90-"
 
         # Stratified age uses a prefix since it's less obvious from the value names
-        data["age"] = age_prefix + data["age"]
+        data["age"] = AGE_PREFIX + data["age"]
 
     # Determine the columns to stack depending on what's available
     stack_columns = [col for col in candidate_columns if col in data.columns]
 
     # Stack the columns which give us a stratified view of the data
-    data = stack_table(
+    return stack_table(
         data, index_columns=index_columns, value_columns=value_columns, stack_columns=stack_columns
     )
 
-    if has_age:
-        # Age ranges are not uniform, so we add a helper variable which indicates the actual range
-        # and make sure that the columns which contain the counts are uniform across all sources
-        age_columns = {col: col.split(age_prefix, 2) for col in data.columns if age_prefix in col}
 
-        # Remove unknown ages from the buckets
-        age_columns = {
-            col: bucket for col, bucket in age_columns.items() if bucket[-1] != "unknown"
+def rename_age_buckets(data: DataFrame) -> DataFrame:
+    """
+    Second step of `stratify_age_sex_ethnicity`, which renames the stacked age columns so they are
+    uniform across all sources and adds the `age_bin_NN` columns with the actual age ranges.
+    """
+    # Age ranges are not uniform, so we add a helper variable which indicates the actual range
+    # and make sure that the columns which contain the counts are uniform across all sources
+    age_columns = {col: col.split(AGE_PREFIX, 2) for col in data.columns if AGE_PREFIX in col}
+
+    # Remove unknown ages from the buckets
+    age_columns = {col: bucket for col, bucket in age_columns.items() if bucket[-1] != "unknown"}
+    age_buckets = unique([bucket[-1] for bucket in age_columns.values()])
+
+    sort_func = lambda x: safe_int_cast(str(x).split("-")[0].split("_")[0]) or 0
+    age_buckets_map = {
+        bucket: f"{idx:02d}" for idx, bucket in enumerate(sorted(age_buckets, key=sort_func))
+    }
+    data = data.rename(
+        columns={
+            col_name_old: f"{prefix}{AGE_PREFIX}{age_buckets_map[bucket]}"
+            for col_name_old, (prefix, bucket) in age_columns.items()
         }
-        age_buckets = unique([bucket[-1] for bucket in age_columns.values()])
+    )
 
-        sort_func = lambda x: safe_int_cast(str(x).split("-")[0].split("_")[0]) or 0
-        age_buckets_map = {
-            bucket: f"{idx:02d}" for idx, bucket in enumerate(sorted(age_buckets, key=sort_func))
+    # Add helper columns to indicate range, assuming all variables have the same buckets
+    return data.assign(
+        **{
+            f"age_bin_{bucket_name}": bucket_range
+            for bucket_range, bucket_name in age_buckets_map.items()
         }
-        data = data.rename(
-            columns={
-                col_name_old: f"{prefix}{age_prefix}{age_buckets_map[bucket]}"
-                for col_name_old, (prefix, bucket) in age_columns.items()
-            }
-        )
-
-        # Add helper columns to indicate range, assuming all variables have the same buckets
-        for bucket_range, bucket_name in age_buckets_map.items():
-            data[f"age_bin_{bucket_name}"] = bucket_range
-
-    return data
+    )
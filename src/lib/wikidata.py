@@ -14,8 +14,8 @@
 
 import sys
 from typing import Any, Dict
-import requests
 from lib.cast import safe_float_cast
+from lib.net import get_session
 
 
 def _all_property_keys(props: Dict[str, str]):
@@ -59,7 +59,7 @@ def _process_property(obj, name: str, prop: str):
 
 def wikidata_properties(props: Dict[str, str], entity: str) -> Dict[str, Any]:
     api_base = "https://www.wikidata.org/w/api.php?action=wbgetclaims&format=json"
-    res = requests.get("{}&entity={}".format(api_base, entity)).json()
+    res = get_session().get("{}&entity={}".format(api_base, entity)).json()
 
     # Early exit: entity not found
     if not res.get("claims"):
@@ -21,6 +21,8 @@ import shutil
 import tempfile
 from pathlib import Path
 
+from pandas import DataFrame
+
 # Add our library utils to the path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
@@ -36,6 +38,14 @@ def snake_to_camel_case(txt: str) -> str:
     return re.sub(r"_(\w)", lambda m: m.group(1).upper(), txt.capitalize())
 
 
+def read_output_table(name: str, **read_opts) -> DataFrame:
+    """ Downloads a CSV table from the production outputs using our shared session and reads it """
+    with tempfile.NamedTemporaryFile(suffix=".csv") as tmp:
+        download(f"{URL_OUTPUTS_PROD}/{name}.csv", tmp)
+        tmp.flush()
+        return read_file(tmp.name, **read_opts)
+
+
 if __name__ == "__main__":
 
     # Create the folder which will be published
@@ -58,7 +68,7 @@ if __name__ == "__main__":
         "population": "Population",
     }
     download_columns = list(rename_columns.keys()) + ["aggregation_level"]
-    main_table = read_file(f"{URL_OUTPUTS_PROD}/main.csv", usecols=download_columns)
+    main_table = read_output_table("main", usecols=download_columns)
     main_table = main_table[main_table.aggregation_level < 2]
 
     print("Creating data.csv file")
@@ -79,7 +89,7 @@ if __name__ == "__main__":
 
     # Create the v1 weather.csv file
     print("Creating weather.csv file")
-    weather = read_file(f"{URL_OUTPUTS_PROD}/weather.csv")
+    weather = read_output_table("weather")
     weather = weather[weather.key.apply(lambda x: len(x.split("_")) < 3)]
     weather = weather.rename(columns={"noaa_distance": "distance", "noaa_station": "station"})
     rename_columns = {col: snake_to_camel_case(col) for col in weather.columns}
@@ -87,7 +97,7 @@ if __name__ == "__main__":
 
     # Create the v1 mobility.csv file
     print("Creating mobility.csv file")
-    mobility = read_file(f"{URL_OUTPUTS_PROD}/mobility.csv")
+    mobility = read_output_table("mobility")
     mobility = mobility[mobility.key.apply(lambda x: len(x.split("_")) < 3)]
     mobility = drop_na_records(mobility, ["date", "key"])
     rename_columns = {
@@ -98,7 +108,7 @@ if __name__ == "__main__":
     # Create the v1 CSV files which only require simple column mapping
     v1_v2_name_map = {"response": "oxford-government-response"}
     for v1_name, v2_name in v1_v2_name_map.items():
-        data = read_file(f"{URL_OUTPUTS_PROD}/{v2_name}.csv")
+        data = read_output_table(v2_name)
         rename_columns = {col: snake_to_camel_case(col) for col in data.columns}
         export_csv(data.rename(columns=rename_columns), public_folder / f"{v1_name}.csv")
 
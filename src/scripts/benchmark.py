@@ -0,0 +1,675 @@
+#!/usr/bin/env python
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script compares the optimized implementations of some of our library functions against
+their reference implementations using synthetic data. Each benchmark asserts that both versions
+produce identical outputs and then prints the time taken by each one. Example usage:
+```sh
+python ./scripts/benchmark.py combine --size 100000
+```
+"""
+
+import os
+import re
+import csv
+import sys
+import json
+import time
+import hashlib
+import warnings
+from pathlib import Path
+from functools import partial
+from threading import Thread
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy
+from pandas import DataFrame, Series, concat, date_range, isna
+from pandas.testing import assert_frame_equal
+from unidecode import unidecode
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# pylint: disable=wrong-import-position
+from lib.anomaly import detect_stale_columns, detect_stale_columns_by_key
+from lib.cast import column_converters, column_casters
+from lib.data_source import DataSource
+from lib.io import fuzzy_text, fuzzy_text_series, read_lines
+from lib.net import download_conditional, read_snapshot_metadata
+from lib.metadata import KeyResolver, load_metadata
+from lib.pipeline import DataPipeline
+from lib.memory_efficient import _external_sort, _read_records, _record_size
+from lib.memory_efficient import UnsortedTableError, table_join, table_sort
+from lib.utils import combine_tables, grouped_cumsum, grouped_diff, stack_table
+
+
+def _timeit(func: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _report(name: str, timings: Dict[str, float]) -> None:
+    baseline = max(timings.values())
+    for label, elapsed in timings.items():
+        print(f"[{name}] {label}: {elapsed:.3f}s ({baseline / max(elapsed, 1e-9):.1f}x)")
+
+
+def _synthetic_sources(size: int, source_count: int, seed: int = 0) -> List[DataFrame]:
+    """ Builds a list of overlapping tables indexed by <date, key> with random null values """
+    rng = numpy.random.RandomState(seed)
+    keys = [f"K{idx:04d}" for idx in range(max(1, size // 100))]
+    dates = [f"2020-{month:02d}-{day:02d}" for month in range(1, 13) for day in range(1, 29)]
+
+    tables = []
+    for _ in range(source_count):
+        data = DataFrame(
+            {
+                "date": rng.choice(dates, size),
+                "key": rng.choice(keys, size),
+                "total_confirmed": rng.randint(0, 1000, size).astype(float),
+                "total_deceased": rng.randint(0, 100, size).astype(float),
+                "source": rng.choice(["a", "b", "c"], size).astype(object),
+            }
+        )
+        for column in ("total_confirmed", "total_deceased", "source"):
+            data.loc[rng.rand(size) < 0.3, column] = None
+        tables.append(data)
+
+    return tables
+
+
+def benchmark_combine(size: int) -> None:
+    tables = _synthetic_sources(size, source_count=4)
+    keys = ["date", "key"]
+    expected, time_reference = _timeit(combine_tables, tables, keys, engine="reference")
+    result, time_columnar = _timeit(combine_tables, tables, keys, engine="columnar")
+    assert_frame_equal(expected, result, check_dtype=False)
+    _report("combine", {"reference": time_reference, "columnar": time_columnar})
+
+
+def _synthetic_values(size: int, seed: int = 0) -> Series:
+    """ Builds a series of values with all the corner cases that the safe cast functions handle """
+    rng = numpy.random.RandomState(seed)
+    digits = rng.randint(0, 4, size)
+    numbers = [float(round(x, n)) for x, n in zip(rng.uniform(-1e6, 1e6, size), digits)]
+    choices = [
+        lambda x: x,
+        lambda x: int(x),
+        lambda x: str(x),
+        lambda x: f"{x:,}",
+        lambda x: str(x).replace("-", "−"),
+        lambda x: f" {x} ",
+        lambda x: None,
+        lambda x: numpy.nan,
+        lambda x: "",
+        lambda x: "N/A",
+        lambda x: "abc",
+        lambda x: f"{x}e2",
+        lambda x: x > 0,
+    ]
+    picks = rng.randint(0, len(choices), size)
+    return Series([choices[pick](number) for pick, number in zip(picks, numbers)], dtype=object)
+
+
+def _assert_cast_equal(expected: Series, result: Series) -> None:
+    for idx, (value_expected, value_result) in enumerate(zip(expected, result)):
+        if isna(value_expected):
+            assert isna(value_result), f"Row {idx}: expected null but found {value_result}"
+        else:
+            assert value_expected == value_result, f"Row {idx}: {value_expected} != {value_result}"
+
+
+def benchmark_cast(size: int) -> None:
+    # Property check: both versions must agree on values with all sorts of corner cases
+    for seed in range(10):
+        values = _synthetic_values(size, seed=seed)
+        for dtype in ("str", "float", "int"):
+            converter = column_converters({"value": dtype})["value"]
+            caster = column_casters({"value": dtype})["value"]
+            _assert_cast_equal(values.apply(converter), caster(values))
+
+    # Property check: dates must be represented the same way as their values
+    dates = Series(date_range("2020-01-01", periods=size, freq="h"))
+    dates[::7] = None
+    for values in (dates, dates - dates[1]):
+        for dtype in ("str", "float", "int"):
+            converter = column_converters({"value": dtype})["value"]
+            caster = column_casters({"value": dtype})["value"]
+            _assert_cast_equal(values.apply(converter), caster(values))
+
+    # Measure performance using values similar to those found in our intermediate outputs
+    rng = numpy.random.RandomState(0)
+    values = Series(rng.randint(0, 1e6, size).astype(str), dtype=object)
+    values[rng.rand(size) < 0.2] = None
+    timings: Dict[str, float] = {}
+    for dtype in ("str", "float", "int"):
+        converter = column_converters({"value": dtype})["value"]
+        caster = column_casters({"value": dtype})["value"]
+        expected, timings[f"{dtype} per-cell"] = _timeit(values.apply, converter)
+        result, timings[f"{dtype} vectorized"] = _timeit(caster, values)
+        _assert_cast_equal(expected, result)
+    _report("cast", timings)
+
+
+def _fuzzy_text_reference(text: str, remove_regex: str = r"[^a-z\s]", remove_spaces: bool = True):
+    """ Original implementation of `fuzzy_text`, which runs each regex uncompiled """
+    text = unidecode(str(text)).lower()
+    for token in ("y", "and", "of"):
+        text = re.sub(f" {token} ", " ", text)
+    text = re.sub(remove_regex, "", text)
+    for word in ("county", "region", "borough", "province", "department", "district"):
+        text = re.sub(f"^{word} ", "", text)
+        text = re.sub(f" {word}$", "", text)
+    text = re.sub(r"\s+", "" if remove_spaces else " ", text)
+    return text.strip()
+
+
+def _synthetic_names(size: int, seed: int = 0) -> Series:
+    """ Builds a series of region names with accents, affixes and a few null values """
+    rng = numpy.random.RandomState(seed)
+    words = ["São", "Paulo", "y", "and", "of", "Río", "county", "Region", "District", "Zürich"]
+    words += ["  ", "-", "1", "\n", "Borough", "province", "Département", "Łódź", "Y", "of of"]
+    names: List[Any] = [
+        " ".join(rng.choice(words, rng.randint(1, 6))) for _ in range(max(1, size // 10))
+    ]
+    names += [None, numpy.nan, ""]
+    return Series(rng.choice(numpy.array(names, dtype=object), size), dtype=object)
+
+
+def benchmark_fuzzy(size: int) -> None:
+    # Property check: the compiled version must agree with the original for all options
+    for seed in range(10):
+        values = _synthetic_names(size, seed=seed)
+        for remove_spaces in (True, False):
+            expected = [
+                _fuzzy_text_reference(value, remove_spaces=remove_spaces) for value in values
+            ]
+            assert expected == [fuzzy_text(value, remove_spaces=remove_spaces) for value in values]
+            result = fuzzy_text_series(values, remove_spaces=remove_spaces)
+            assert expected == result.tolist()
+
+    values = _synthetic_names(size, seed=100)
+    _, time_reference = _timeit(values.apply, _fuzzy_text_reference)
+    _, time_series = _timeit(fuzzy_text_series, values)
+    _report("fuzzy", {"reference": time_reference, "series": time_series})
+
+
+def _captured_warnings(func: Callable, *args, **kwargs) -> List[str]:
+    with warnings.catch_warnings(record=True) as records:
+        warnings.simplefilter("always")
+        func(*args, **kwargs)
+    return sorted(str(record.message) for record in records)
+
+
+def _stale_columns_reference(schema: Dict[str, Any], data: DataFrame, name: str) -> None:
+    """ Original implementation of the full verification, which filters the table once per key """
+    for key in data.key.unique():
+        detect_stale_columns(schema, data[data.key == key], [name, key])
+
+
+def benchmark_verify(size: int) -> None:
+    schema = {"date": "str", "key": "str", "total_confirmed": "int", "total_deceased": "int"}
+
+    # Property check: both versions must report the same stale columns for every key
+    for seed in range(10):
+        data = _synthetic_sources(size, source_count=1, seed=seed)[0].drop(columns=["source"])
+        rng = numpy.random.RandomState(seed)
+        stale_keys = rng.choice(data.key.unique(), 5)
+        data.loc[data.key.isin(stale_keys) & (data.date > "2020-06"), "total_deceased"] = None
+        expected = _captured_warnings(_stale_columns_reference, schema, data, "test")
+        result = _captured_warnings(detect_stale_columns_by_key, schema, data, ["test"])
+        assert expected == result, f"{expected} != {result}"
+
+    timings: Dict[str, float] = {}
+    _, timings["per-key"] = _timeit(_captured_warnings, _stale_columns_reference, schema, data, "x")
+    _, timings["grouped"] = _timeit(
+        _captured_warnings, detect_stale_columns_by_key, schema, data, ["x"]
+    )
+    _report("verify", timings)
+
+
+def _grouped_transform_reference(
+    data: DataFrame, transform: Callable, prefix: Tuple[str, str]
+) -> DataFrame:
+    """ Original implementation of `grouped_transform`, which transforms one group at a time """
+    data = data.sort_values(["key", "date"])
+    value_columns = [col for col in data.columns if col not in ("key", "date")]
+    output = data.dropna(subset=value_columns, how="all").copy()
+    for column in value_columns:
+        if output[column].isnull().all():
+            continue
+        groups = [transform(group[column]) for _, group in data.groupby("key")]
+        output[prefix[0] + column.replace(prefix[1], "")] = concat(groups)
+    return output
+
+
+def benchmark_grouped(size: int) -> None:
+    keys = ["key", "date"]
+    tables = _synthetic_sources(size, source_count=10)
+    for idx, data in enumerate(tables):
+        data = data.drop(columns=["source"]).drop_duplicates(subset=keys)
+        data.index = numpy.random.RandomState(idx).permutation(len(data))
+        tables[idx] = data
+
+    # Property check: both versions must agree on tables with nulls and unsorted indices
+    timings: Dict[str, float] = {"reference": 0, "vectorized": 0}
+    kernels = [
+        (grouped_diff, lambda x: x.ffill().diff(), ("new_", "total_")),
+        (grouped_cumsum, lambda x: x.fillna(0).cumsum(), ("total_", "new_")),
+    ]
+    for data in tables:
+        for func, transform, prefix in kernels:
+            data = data.rename(columns=lambda x: x.replace(prefix[0], prefix[1]))
+            expected, elapsed = _timeit(_grouped_transform_reference, data, transform, prefix)
+            timings["reference"] += elapsed
+            result, elapsed = _timeit(func, data, keys)
+            timings["vectorized"] += elapsed
+            assert_frame_equal(expected, result)
+
+    _report("grouped", timings)
+
+
+def _stack_table_reference(
+    data: DataFrame, index_columns: List[str], value_columns: List[str], stack_columns: List[str]
+) -> DataFrame:
+    """ Original implementation of `stack_table`, which pivots one value column at a time """
+    output = data.drop(columns=stack_columns).groupby(index_columns).sum()
+    for col_stack in stack_columns:
+        col_stack_values = data[col_stack].dropna().unique()
+        for col_variable in value_columns:
+            df = data[index_columns + [col_variable, col_stack]].copy()
+            df = df.pivot_table(
+                values=col_variable, index=index_columns, columns=[col_stack], aggfunc="sum"
+            )
+            column_mapping = {suffix: f"{col_variable}_{suffix}" for suffix in col_stack_values}
+            df = df.rename(columns=column_mapping)
+            transfer_columns = list(column_mapping.values())
+            output[transfer_columns] = df[transfer_columns]
+    return output.reset_index()
+
+
+def benchmark_stack(size: int) -> None:
+    rng = numpy.random.RandomState(0)
+    index_columns = ["key", "date"]
+    stack_columns = ["age", "sex"]
+    data = _synthetic_sources(size, source_count=1)[0].drop(columns=["source"])
+    data["age"] = rng.choice([f"age_{age:02d}" for age in range(0, 100, 5)], size)
+    data["sex"] = rng.choice(["male", "female", None], size)
+    value_columns = [
+        f"{col}_{idx}" for col in ("total_confirmed", "total_deceased") for idx in range(5)
+    ]
+    for column in value_columns:
+        data[column] = data[column.rsplit("_", 1)[0]]
+    value_columns += ["total_confirmed", "total_deceased"]
+
+    args = (data, index_columns, value_columns, stack_columns)
+    with warnings.catch_warnings():
+        # The reference implementation inserts columns one by one, which pandas warns about
+        warnings.simplefilter("ignore")
+        expected, time_reference = _timeit(_stack_table_reference, *args)
+    result, time_unstack = _timeit(stack_table, *args)
+    assert_frame_equal(expected, result)
+    _report("stack", {"reference": time_reference, "unstack": time_unstack})
+
+
+def benchmark_sort(size: int) -> None:
+    rng = numpy.random.RandomState(0)
+    columns = ["key", "date"] + [f"column_{idx:02d}" for idx in range(20)]
+    records = [
+        [f"K{key:04d}", f"2020-{month:02d}"] + [str(value) for value in values]
+        for key, month, values in zip(
+            rng.randint(0, 1000, size), rng.randint(1, 13, size), rng.randint(0, 1e6, (size, 20))
+        )
+    ]
+    sort_key = lambda record: record[:2]
+
+    # Property check: the number of runs must be determined by the size of all the record fields
+    total_size = sum(_record_size(record) for record in records)
+    memory_budget = total_size // 8
+    run_paths: List[Path] = []
+
+    def write_run(path: Path, run: Any) -> None:
+        run_paths.append(path)
+        with open(path, "w") as fd:
+            csv.writer(fd).writerows(run)
+
+    result = list(_external_sort(records, sort_key, memory_budget, write_run, _read_records))
+    assert result == sorted(records, key=sort_key)
+    assert 8 <= len(run_paths) <= 9, f"Expected 8 runs but found {len(run_paths)}"
+
+    with TemporaryDirectory() as temp_folder:
+        table_path = Path(temp_folder) / "table.csv"
+        with open(table_path, "w") as fd:
+            csv.writer(fd).writerows([columns] + records)
+
+        timings: Dict[str, float] = {}
+        sort_args = (table_path, Path(temp_folder) / "output.csv", ["key", "date"])
+        _, timings["in-memory"] = _timeit(table_sort, *sort_args, memory_budget=total_size * 2)
+        _, timings["external"] = _timeit(table_sort, *sort_args, memory_budget=memory_budget)
+        output = list(csv.reader(read_lines(sort_args[1])))
+        assert output == [columns] + result
+
+    _report("sort", timings)
+
+
+def _table_join_reference(left: Path, right: Path, key_size: int, how: str) -> List[List[str]]:
+    """ Joins two tables in memory, using the last record of each key of the right table """
+    columns_left, *records_left = list(csv.reader(read_lines(left)))
+    columns_right, *records_right = list(csv.reader(read_lines(right)))
+    lookup = {tuple(record[:key_size]): record[key_size:] for record in records_right}
+    empty_right = [""] * (len(columns_right) - key_size)
+    output = [columns_left + columns_right[key_size:]]
+    for record in records_left:
+        data = lookup.get(tuple(record[:key_size]))
+        if data is not None or how == "outer":
+            output.append(record + (empty_right if data is None else data))
+    return output
+
+
+def benchmark_join(size: int) -> None:
+    rng = numpy.random.RandomState(0)
+    keys = sorted({f"K{key:06d}" for key in rng.randint(0, size, size)})
+    records_left = [[key, date] for key in keys for date in ("2020-01", "2020-02")]
+    records_right = [
+        [key, date, str(value)]
+        for key, date, value in zip(
+            rng.choice(keys, size), rng.choice(["2020-01", "2020-02", "2020-03"], size), range(size)
+        )
+    ]
+
+    timings: Dict[str, float] = {}
+    with TemporaryDirectory() as temp_folder:
+        left, right = Path(temp_folder) / "left.csv", Path(temp_folder) / "right.csv"
+        output = Path(temp_folder) / "output.csv"
+        with open(left, "w") as fd:
+            csv.writer(fd).writerows([["key", "date"]] + records_left)
+
+        # Property check: all engines must produce the same output as joining in memory, and the
+        # grace engine must not run out of file descriptors with a tiny memory budget
+        # Sorting is stable, so the last record of each key is the same in both versions
+        for is_sorted in (False, True):
+            if is_sorted:
+                records_right = sorted(records_right, key=lambda record: record[:2])
+            with open(right, "w") as fd:
+                csv.writer(fd).writerows([["key", "date", "value"]] + records_right)
+
+            right_size = right.stat().st_size
+            for how in ("inner", "outer"):
+                expected = _table_join_reference(left, right, 2, how)
+                for engine, memory_budget in [
+                    ("auto", right_size * 2),
+                    ("auto", right_size // 8),
+                    ("hash", right_size * 2),
+                    ("grace", right_size // 8),
+                    ("grace", 1),
+                    ("merge", right_size * 2),
+                ]:
+                    join_args = (left, right, ["key", "date"], output, how, engine, memory_budget)
+                    try:
+                        table_join(*join_args)
+                    except UnsortedTableError:
+                        assert engine == "merge" and not is_sorted
+                        continue
+                    result = list(csv.reader(read_lines(output)))
+                    assert result == expected, f"Engine {engine} with budget {memory_budget}"
+
+        for engine in ("merge", "hash", "grace"):
+            join_args = (left, right, ["key", "date"], output, "outer", engine, right_size // 8)
+            _, timings[engine] = _timeit(table_join, *join_args)
+
+    _report("join", timings)
+
+
+class _SyntheticDataSource(DataSource):
+    """ Data source which renames the region column of a single CSV file so it can be merged """
+
+    def parse_dataframes(
+        self, dataframes: Dict[Any, DataFrame], aux: Dict[str, DataFrame], **parse_opts
+    ) -> DataFrame:
+        return dataframes[0].rename(columns={"region": "subregion1_code"})
+
+
+def benchmark_parse(size: int) -> None:
+    regions = ["MD", "CT", "AN", "VC"]
+    metadata = DataFrame(
+        {
+            "key": ["ES"] + [f"ES_{region}" for region in regions],
+            "country_code": "ES",
+            "country_name": "Spain",
+            "subregion1_code": [None] + regions,
+            "subregion1_name": [None] + [region.lower() for region in regions],
+            "subregion2_code": None,
+            "subregion2_name": None,
+            "match_string": None,
+        }
+    )
+    aux = {"metadata": metadata}
+
+    rng = numpy.random.RandomState(0)
+    data = DataFrame(
+        {
+            "date": rng.choice([f"2020-{month:02d}-01" for month in range(1, 13)], size),
+            "country_code": "ES",
+            "region": rng.choice(regions, size),
+            "age": rng.choice(["0-9", "10-19", "20-29", "95-99", "unknown"], size),
+            "sex": rng.choice(["male", "female"], size),
+            "new_confirmed": rng.randint(0, 100, size),
+            "new_deceased": rng.choice([0, 1, numpy.nan], size),
+        }
+    )
+
+    # Property check: parsing in chunks must produce the same output as parsing the whole file
+    with TemporaryDirectory() as temp_folder, warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        sources = {0: str(Path(temp_folder) / "data.csv")}
+        data.to_csv(sources[0], index=False)
+
+        timings: Dict[str, float] = {}
+        expected, timings["whole"] = _timeit(_SyntheticDataSource().run_parse, sources, aux)
+        for chunksize in (size // 7 + 1, size // 2 + 1):
+            config = {"parse": {"chunksize": chunksize}}
+            result, timings[f"chunks of {chunksize}"] = _timeit(
+                _SyntheticDataSource(config).run_parse, sources, aux
+            )
+            assert_frame_equal(expected, result, check_dtype=False)
+
+    _report("parse", timings)
+
+
+class _SnapshotRequestHandler(BaseHTTPRequestHandler):
+    """ Serves the contents of its server, honoring conditional and (if-)range requests """
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        contents, etag = self.server.contents, self.server.etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        offset = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            offset = int(re.match(r"bytes=(\d+)-", range_header).group(1))
+            if offset >= len(contents):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(contents)}")
+                self.end_headers()
+                return
+
+        self.send_response(206 if offset > 0 else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(contents) - offset))
+        if offset > 0:
+            self.send_header("Content-Range", f"bytes {offset}-{len(contents) - 1}/{len(contents)}")
+        self.end_headers()
+        self.wfile.write(contents[offset:])
+        self.server.bytes_sent += len(contents) - offset
+
+
+def benchmark_net(size: int) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SnapshotRequestHandler)
+    server.contents, server.etag, server.bytes_sent = os.urandom(size * 100), '"v1"', 0
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/data.csv"
+
+    def assert_downloaded(file_path: Path) -> None:
+        assert file_path.read_bytes() == server.contents
+        metadata = read_snapshot_metadata(file_path)
+        assert metadata["sha256"] == hashlib.sha256(server.contents).hexdigest()
+        assert metadata["etag"] == server.etag and metadata["partial"] is None
+        assert not file_path.with_name(f"{file_path.name}.part").exists()
+
+    def interrupt(file_path: Path, partial_contents: bytes) -> None:
+        metadata = read_snapshot_metadata(file_path)
+        with open(file_path.with_name(f"{file_path.name}.meta.json"), "w") as fd:
+            json.dump({**metadata, "partial": {"etag": server.etag}}, fd)
+        file_path.with_name(f"{file_path.name}.part").write_bytes(partial_contents)
+
+    timings: Dict[str, float] = {}
+    with TemporaryDirectory() as temp_folder:
+        file_path = Path(temp_folder) / "data.csv"
+
+        # Property check: unchanged resources are not transferred again
+        assert download_conditional(url, file_path)
+        assert_downloaded(file_path)
+        bytes_sent = server.bytes_sent
+        assert not download_conditional(url, file_path)
+        assert server.bytes_sent == bytes_sent
+        assert_downloaded(file_path)
+
+        # Property check: interrupted downloads only transfer the remaining bytes
+        half = len(server.contents) // 2
+        server.etag = '"v2"'
+        interrupt(file_path, server.contents[:half])
+        bytes_sent = server.bytes_sent
+        _, timings["resume"] = _timeit(download_conditional, url, file_path)
+        assert server.bytes_sent - bytes_sent == len(server.contents) - half
+        assert_downloaded(file_path)
+
+        # Property check: a complete partial download is accepted instead of failing with a 416
+        server.etag = '"v3"'
+        interrupt(file_path, server.contents)
+        bytes_sent = server.bytes_sent
+        assert download_conditional(url, file_path)
+        assert server.bytes_sent == bytes_sent
+        assert_downloaded(file_path)
+
+        # Property check: a partial download longer than the resource is downloaded again
+        server.etag = '"v4"'
+        interrupt(file_path, server.contents + b"garbage")
+        assert download_conditional(url, file_path)
+        assert_downloaded(file_path)
+
+        # Property check: concurrent downloads of the same URL do not corrupt each other
+        file_path.unlink()
+        threads = [Thread(target=download_conditional, args=(url, file_path)) for _ in range(8)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        timings["concurrent"] = time.perf_counter() - start
+        assert_downloaded(file_path)
+
+        _, timings["full"] = _timeit(download_conditional, url, Path(temp_folder) / "full.csv")
+
+    server.shutdown()
+    _report("net", timings)
+
+
+def benchmark_metadata(size: int) -> None:
+    regions = [f"R{idx:05d}" for idx in range(max(1, size // 10))]
+    metadata = DataFrame(
+        {
+            "key": ["XX"] + [f"XX_{region}" for region in regions],
+            "country_code": "XX",
+            "country_name": "Country",
+            "subregion1_code": [None] + regions,
+            "subregion1_name": [None] + [f"Region {region}" for region in regions],
+            "subregion2_code": None,
+            "subregion2_name": None,
+            "match_string": None,
+        }
+    )
+    data = DataFrame({"date": "2020-01-01", "country_code": "XX", "region": regions})
+
+    # Count the resolvers built, without writing the disk cache so only the memo is exercised
+    build_count = [0]
+    resolver_init = KeyResolver.__init__
+
+    def counting_init(resolver: KeyResolver, table: DataFrame) -> None:
+        build_count[0] += 1
+        resolver_init(resolver, table)
+
+    timings: Dict[str, float] = {}
+    with TemporaryDirectory() as temp_folder, patch.object(
+        KeyResolver, "__init__", counting_init
+    ), patch("lib.pipeline.load_metadata", partial(load_metadata, cache_folder=None)):
+        auxiliary = {"metadata": Path(temp_folder) / "metadata.csv"}
+        metadata.to_csv(auxiliary["metadata"], index=False)
+        sources = {0: str(Path(temp_folder) / "data.csv")}
+        data.to_csv(sources[0], index=False)
+
+        # Property check: pipelines loaded in the same process reuse the resolver of the first one
+        resolvers = []
+        for label in ("first", "second"):
+            pipeline = DataPipeline("metadata", {}, auxiliary, [])
+            resolver, timings[label] = _timeit(pipeline._get_key_resolver)
+            assert resolver.metadata is pipeline.auxiliary_tables["metadata"]
+            resolvers.append(resolver)
+        assert resolvers[0].metadata is not resolvers[1].metadata
+        assert resolvers[0]._value_index is resolvers[1]._value_index
+        assert build_count[0] == 1, f"Expected 1 resolver build but found {build_count[0]}"
+
+        # Property check: data sources merge their records using the resolver they are given
+        aux = pipeline.auxiliary_tables
+        result = _SyntheticDataSource().run_parse(sources, aux, key_resolver=resolvers[1])
+        assert result.key.tolist() == [f"XX_{region}" for region in regions]
+        assert build_count[0] == 1, f"Expected 1 resolver build but found {build_count[0]}"
+
+    _report("metadata", timings)
+
+
+BENCHMARKS: Dict[str, Callable[[int], None]] = {
+    "combine": benchmark_combine,
+    "cast": benchmark_cast,
+    "fuzzy": benchmark_fuzzy,
+    "verify": benchmark_verify,
+    "grouped": benchmark_grouped,
+    "stack": benchmark_stack,
+    "sort": benchmark_sort,
+    "join": benchmark_join,
+    "parse": benchmark_parse,
+    "net": benchmark_net,
+    "metadata": benchmark_metadata,
+}
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser()
+    argparser.add_argument("benchmarks", type=str, nargs="*", default=list(BENCHMARKS.keys()))
+    argparser.add_argument("--size", type=int, default=10000)
+    args = argparser.parse_args()
+
+    for benchmark_name in args.benchmarks:
+        BENCHMARKS[benchmark_name](args.size)
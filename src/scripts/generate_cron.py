@@ -33,7 +33,7 @@ import yaml
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 # pylint: disable=wrong-import-position
-from lib.pipeline_tools import get_pipelines
+from lib.pipeline_tools import get_pipeline_configs
 
 
 def get_cron_jobs() -> Iterator[Dict]:
@@ -75,24 +75,24 @@ def get_cron_jobs() -> Iterator[Dict]:
     # Keep track of the different job groups to only output them once
     job_urls_seen = set()
 
-    for data_pipeline in get_pipelines():
+    for pipeline_config in get_pipeline_configs():
         # The job that combines data sources into a table runs hourly
         yield {
-            "url": f"/combine_table?table={data_pipeline.table}",
+            "url": f"/combine_table?table={pipeline_config.table}",
             # Offset by 15 minutes to let other hourly tasks finish
             "schedule": "every 1 hours from 00:15 to 23:15",
             **copy.deepcopy(retry_params),
         }
 
-        for idx, data_source in enumerate(data_pipeline.data_sources):
+        for idx, source_config in enumerate(pipeline_config.source_configs):
             # The job to pull each individual data source runs hourly unless specified otherwise
-            job_sched = data_source.config.get("automation", {}).get("schedule", sched_hourly)
+            job_sched = source_config.get("automation", {}).get("schedule", sched_hourly)
 
             # Each data source has a job group. All data sources within the same job group are run
             # as part of the same job in series. The default job group is the index of the data
             # source.
-            job_group = data_source.config.get("automation", {}).get("job_group", idx)
-            job_url = f"/update_table?table={data_pipeline.table}&job_group={job_group}"
+            job_group = source_config.get("automation", {}).get("job_group", idx)
+            job_url = f"/update_table?table={pipeline_config.table}&job_group={job_group}"
 
             if job_url not in job_urls_seen:
                 job_urls_seen.add(job_url)
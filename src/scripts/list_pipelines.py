@@ -28,7 +28,7 @@ sys.path.append(path)
 
 from pandas import DataFrame
 from lib.constants import SRC
-from lib.pipeline import DataPipeline
+from lib.pipeline import DataPipelineConfig
 from typing import List, Iterator, Dict
 
 
@@ -42,10 +42,9 @@ def get_source_configs(pipeline_names: List[str]) -> Iterator[Dict]:
     """Map a list of pipeline names to their source configs."""
 
     for pipeline_name in pipeline_names:
-        data_pipeline = DataPipeline.load(pipeline_name)
+        pipeline_config = DataPipelineConfig.read(pipeline_name)
 
-        for data_source in data_pipeline.data_sources:
-            data_source_config = data_source.config
+        for data_source_config in pipeline_config.source_configs:
 
             data_source_name = data_source_config.get("name")
             data_source_fetch_params = data_source_config.get("fetch", [])
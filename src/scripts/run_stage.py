@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script runs a single stage of a data pipeline, so each stage can be scheduled separately
+using workers sized appropriately for it. Each stage persists its outputs into the output folder
+where the next stage picks them up. To run all the stages of a pipeline in order, run the
+following commands from the `src` folder:
+```sh
+python ./scripts/run_stage.py fetch epidemiology --thread-count 32
+python ./scripts/run_stage.py parse epidemiology --process-count 8
+python ./scripts/run_stage.py combine epidemiology
+python ./scripts/run_stage.py verify epidemiology --verify-level full
+```
+"""
+
+import os
+import sys
+from pathlib import Path
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# pylint: disable=wrong-import-position
+from lib.constants import SRC
+from lib.pipeline import DataPipeline, INTERMEDIATE_FORMATS
+
+
+if __name__ == "__main__":
+
+    # Parse arguments from the command line
+    argparser = ArgumentParser()
+    argparser.add_argument("stage", type=str, choices=["fetch", "parse", "combine", "verify"])
+    argparser.add_argument("pipeline", type=str)
+    argparser.add_argument("--output-folder", type=str, default=str(SRC / ".." / "output"))
+    argparser.add_argument("--thread-count", type=int, default=cpu_count() * 4)
+    argparser.add_argument("--process-count", type=int, default=cpu_count())
+    argparser.add_argument(
+        "--intermediate-format", type=str, default="npz", choices=list(INTERMEDIATE_FORMATS.keys())
+    )
+    argparser.add_argument("--verify-level", type=str, default="simple")
+    argparser.add_argument("--force", action="store_true")
+    args = argparser.parse_args()
+
+    output_folder = Path(args.output_folder)
+    data_pipeline = DataPipeline.load(args.pipeline)
+
+    if args.stage == "fetch":
+        data_pipeline.run_fetch(output_folder, thread_count=args.thread_count)
+
+    if args.stage == "parse":
+        data_pipeline.run_parse(
+            output_folder,
+            process_count=args.process_count,
+            intermediate_format=args.intermediate_format,
+        )
+
+    if args.stage == "combine":
+        output = data_pipeline.run_combine(
+            output_folder, intermediate_format=args.intermediate_format, force=args.force
+        )
+        if output is None:
+            print(f"Intermediate results unchanged, skipping combine for {data_pipeline.table}")
+
+    if args.stage == "verify":
+        data_pipeline.run_verify(
+            output_folder, level=args.verify_level, process_count=args.process_count
+        )